@@ -0,0 +1,147 @@
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import uuid
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+
+from nbrepo.models import Blob
+
+# Linux ioctl request to share the extents of one file with another (copy-on-write clone)
+FICLONE = 0x40049409
+
+
+def _store_path():
+    return getattr(settings, 'BLOB_STORE_PATH', './data/blobs/')
+
+
+def blob_path(digest):
+    """
+    Return the path of the blob with the given digest, fanned out by its first two characters
+    """
+    return os.path.join(_store_path(), digest[:2], digest)
+
+
+def file_digest(path):
+    """
+    Return the SHA-256 hex digest of the file at path, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _temp_path(path):
+    return os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.' + uuid.uuid4().hex[:8] + '.tmp')
+
+
+def _reflink(src, dst):
+    # Clone the file if the filesystem supports it (btrfs, xfs), otherwise raise OSError
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst)
+            raise
+
+
+def _replace_with(src, dst, allow_hardlink):
+    """
+    Atomically replace dst with a hardlink (if allowed), a reflink or a plain copy of src,
+    in that order of preference. Replacing instead of writing in place means a file that
+    was linked to a blob is never modified through the link.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    temp = _temp_path(dst)
+    try:
+        if allow_hardlink:
+            try:
+                os.link(src, temp)
+                os.replace(temp, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+        try:
+            _reflink(src, temp)
+        except OSError:
+            shutil.copyfile(src, temp)
+        os.replace(temp, dst)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def replace_file(src, dst):
+    """
+    Atomically replace dst with a copy of src, without writing through an existing hardlink
+    """
+    _replace_with(src, dst, allow_hardlink=False)
+
+
+def intern(path):
+    """
+    Add the file at path to the blob store, replace the file with a hardlink to the blob
+    where the filesystem allows, and take a reference to the blob. Returns the digest.
+    """
+    digest = file_digest(path)
+    size = os.path.getsize(path)
+
+    # Take the reference first, so a concurrent release can't remove the blob under us
+    with transaction.atomic():
+        if not Blob.objects.filter(digest=digest).update(refcount=F('refcount') + 1):
+            try:
+                with transaction.atomic():
+                    Blob.objects.create(digest=digest, size=size, refcount=1)
+            except IntegrityError:
+                Blob.objects.filter(digest=digest).update(refcount=F('refcount') + 1)
+
+    # Lazily write the blob, read-only so nothing can modify it through a hardlink
+    stored = blob_path(digest)
+    if not os.path.exists(stored):
+        _replace_with(path, stored, allow_hardlink=True)
+        os.chmod(stored, 0o444)
+
+    # Point the file at the blob
+    _replace_with(stored, path, allow_hardlink=True)
+    return digest
+
+
+def release(digest):
+    """
+    Drop a reference to the blob, removing it once nothing refers to it
+    """
+    if not digest:
+        return
+
+    with transaction.atomic():
+        Blob.objects.filter(digest=digest).update(refcount=F('refcount') - 1)
+        unused = Blob.objects.filter(digest=digest, refcount__lte=0).delete()[0] > 0
+
+    if unused:
+        try:
+            os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+
+def materialize(source_path, dest_path, digest=None):
+    """
+    Write an independent copy of a stored notebook to dest_path, such as a user's copy.
+    Uses a copy-on-write clone of the blob where the filesystem supports it, so that the
+    copy shares its bytes on disk but can be edited freely, and a plain copy otherwise.
+    Copies are never hardlinked, since edits would write through to every other copy.
+    """
+    stored = blob_path(digest) if digest else None
+    src = stored if stored and os.path.exists(stored) else source_path
+    try:
+        _reflink(src, dest_path)
+    except OSError:
+        shutil.copyfile(src, dest_path)
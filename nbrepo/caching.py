@@ -0,0 +1,75 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from rest_framework import status
+from rest_framework.response import Response
+
+from nbrepo.models import CatalogVersion
+
+
+def catalog_version():
+    """
+    Return the current catalog version, lazily creating the counter if necessary
+    """
+    counter, created = CatalogVersion.objects.get_or_create(pk=1)
+    return counter.version
+
+
+def bump_catalog_version():
+    """
+    Invalidate every cached catalog response by incrementing the catalog version
+    """
+    updated = CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1)
+    if not updated:
+        CatalogVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [t.strip() for t in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+
+def cached_catalog_response(request, build_response):
+    """
+    Return the cached response for this catalog read, calling build_response() on a miss.
+    The cache key and the strong ETag are derived from the catalog version and the full
+    request URL, so every catalog change invalidates all previously cached responses.
+    """
+    version = catalog_version()
+    request_key = request.build_absolute_uri() + '|' + request.META.get('HTTP_ACCEPT', '')
+    digest = hashlib.sha1(request_key.encode('utf-8')).hexdigest()
+    cache_key = 'catalog:%s:%s' % (version, digest)
+    etag = '"%s-%s"' % (version, digest)
+
+    # If the client already has this version, don't send it again
+    if _etag_matches(request, etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
+
+    # Serve from the cache or build and cache the response
+    cached = cache.get(cache_key)
+    if cached is not None:
+        response = Response(cached)
+    else:
+        response = build_response()
+        if response.status_code == status.HTTP_200_OK:
+            cache.set(cache_key, response.data, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 86400))
+
+    if response.status_code == status.HTTP_200_OK:
+        response['ETag'] = etag
+    return response
+
+
+class CatalogCacheMixin(object):
+    """
+    Viewset mixin that serves list and detail reads from the versioned catalog cache
+    """
+
+    def list(self, request, *args, **kwargs):
+        return cached_catalog_response(request, lambda: super(CatalogCacheMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_catalog_response(request, lambda: super(CatalogCacheMixin, self).retrieve(request, *args, **kwargs))
@@ -0,0 +1,247 @@
+import atexit
+import fcntl
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import date
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+
+from nbrepo.models import CounterBatch, Notebook, NotebookUsage
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# The notebook fields that can be incremented through the counter service
+COUNTER_FIELDS = ('launched', 'copied')
+
+
+class CounterService(object):
+    """
+    Write-behind buffer for the notebook launch and copy counters.
+
+    Increments are added to an in-memory buffer and appended to a journal file owned
+    by this process, then applied to the notebook totals and the daily usage table
+    in one transaction every COUNTER_FLUSH_INTERVAL seconds. Each process holds an
+    exclusive lock on its own journal for its lifetime, so journals left behind by a
+    worker that died before flushing are replayed the next time a worker starts. The
+    names of the journals are recorded in the same transaction as their counts, so a
+    journal applied just before its worker died is removed instead of replayed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()   # (notebook_id, field, day) -> count not yet in the database
+        self._rotated = []          # Journal files already swapped out but not yet flushed
+        self._pid = None
+        self._name = None
+        self._journal = None
+        self._lock_file = None
+        self._sequence = 0
+
+    @staticmethod
+    def _journal_dir():
+        return getattr(settings, 'COUNTER_JOURNAL_PATH', './data/counters/')
+
+    def _path(self, suffix):
+        return os.path.join(self._journal_dir(), self._name + suffix)
+
+    def _ensure_started(self):
+        # Start lazily in each process, so that forked web workers get their own journal
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self._name = '%d-%s' % (self._pid, uuid.uuid4().hex[:8])
+        self._pending = Counter()
+        self._rotated = []
+        os.makedirs(self._journal_dir(), exist_ok=True)
+
+        # Hold the lock file for the life of the process to mark the journal as live
+        self._lock_file = open(self._path('.lock'), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._journal = open(self._path('.journal'), 'a')
+
+        # Replay anything left behind by workers that have since exited
+        self._recover_orphans()
+
+        # Flush periodically and on a clean shutdown
+        thread = threading.Thread(target=self._flush_loop, name='counter-flush', daemon=True)
+        thread.start()
+        atexit.register(self.flush)
+
+    def increment(self, notebook_id, field):
+        """
+        Atomically add one to the given counter of the given notebook
+        """
+        if field not in COUNTER_FIELDS:
+            raise ValueError('Unknown counter: ' + str(field))
+
+        today = date.today().isoformat()
+        with self._lock:
+            self._ensure_started()
+            self._journal.write('%d %s %s\n' % (int(notebook_id), field, today))
+            self._journal.flush()
+            self._pending[(int(notebook_id), field, today)] += 1
+
+    def pending(self):
+        """
+        Return the increments of this process not yet written to the database,
+        as a dict of notebook_id -> {field: count}
+        """
+        with self._lock:
+            deltas = {}
+            for (notebook_id, field, day), count in self._pending.items():
+                deltas.setdefault(notebook_id, dict.fromkeys(COUNTER_FIELDS, 0))[field] += count
+            return deltas
+
+    def counts(self, notebook):
+        """
+        Return the current counts of the notebook, including the pending increments of this
+        process. Increments buffered by other worker processes are only included once they
+        flush, so counts may differ between workers for up to COUNTER_FLUSH_INTERVAL seconds.
+        """
+        delta = self.pending().get(notebook.id, {})
+        return {field: getattr(notebook, field) + delta.get(field, 0) for field in COUNTER_FIELDS}
+
+    def flush(self):
+        """
+        Apply all buffered increments to the database in a single transaction
+        """
+        with self._lock:
+            if self._pid != os.getpid() or not self._pending:
+                return
+
+            # Swap the buffer and the journal so that increments can continue during the write
+            snapshot = self._pending
+            self._pending = Counter()
+            self._journal.close()
+            self._sequence += 1
+            rotated = self._path('.%d.flushing' % self._sequence)
+            os.rename(self._path('.journal'), rotated)
+            self._rotated.append(rotated)
+            rotated_paths = list(self._rotated)
+            self._journal = open(self._path('.journal'), 'a')
+
+        try:
+            _apply_counts(snapshot, [os.path.basename(path) for path in rotated_paths])
+        except Exception as e:
+            # Put the increments back, the rotated journals stay on disk until a flush succeeds
+            logger.error("Unable to flush notebook counters: " + str(e))
+            with self._lock:
+                self._pending.update(snapshot)
+            return
+
+        with self._lock:
+            for path in rotated_paths:
+                os.remove(path)
+            self._rotated = [path for path in self._rotated if path not in rotated_paths]
+        _forget_batches([os.path.basename(path) for path in rotated_paths])
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(getattr(settings, 'COUNTER_FLUSH_INTERVAL', 30))
+            self.flush()
+            connection.close()
+
+    def _recover_orphans(self):
+        journal_dir = self._journal_dir()
+        for lock_name in os.listdir(journal_dir):
+            if not lock_name.endswith('.lock') or lock_name == self._name + '.lock':
+                continue
+
+            # If the lock can be taken, the process that owned these journals is gone
+            name = lock_name[:-len('.lock')]
+            try:
+                orphan_lock = open(os.path.join(journal_dir, lock_name), 'r')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(orphan_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                orphan_lock.close()
+                continue
+
+            try:
+                names = [f for f in os.listdir(journal_dir) if f.startswith(name + '.') and not f.endswith('.lock')]
+
+                # Skip the journals the worker applied before it died, but didn't get to remove
+                applied = set(CounterBatch.objects.filter(name__in=names).values_list('name', flat=True))
+                unapplied = [f for f in names if f not in applied]
+                if unapplied:
+                    _apply_counts(_read_journals([os.path.join(journal_dir, f) for f in unapplied]), unapplied)
+
+                for f in names:
+                    os.remove(os.path.join(journal_dir, f))
+                os.remove(os.path.join(journal_dir, lock_name))
+                _forget_batches(names)
+            except Exception as e:
+                logger.error("Unable to recover notebook counters from " + name + ": " + str(e))
+            finally:
+                orphan_lock.close()
+
+
+def _read_journals(paths):
+    counts = Counter()
+    for path in paths:
+        with open(path, 'r') as journal:
+            for line in journal:
+                parts = line.split()
+                if len(parts) == 3 and parts[1] in COUNTER_FIELDS:
+                    counts[(int(parts[0]), parts[1], parts[2])] += 1
+    return counts
+
+
+def _add_daily_usage(notebook_id, day, counts):
+    updates = {field: F(field) + count for field, count in counts.items()}
+    if NotebookUsage.objects.filter(notebook_id=notebook_id, date=day).update(**updates):
+        return
+
+    # No row for this day yet, create one unless another worker just did
+    try:
+        with transaction.atomic():
+            NotebookUsage.objects.create(notebook_id=notebook_id, date=day, **counts)
+    except IntegrityError:
+        NotebookUsage.objects.filter(notebook_id=notebook_id, date=day).update(**updates)
+
+
+def _apply_counts(counts, batches):
+    # Group the increments so that each notebook and each day is updated once
+    totals = {}
+    daily = {}
+    for (notebook_id, field, day), count in counts.items():
+        totals.setdefault(notebook_id, Counter())[field] += count
+        daily.setdefault((notebook_id, day), Counter())[field] += count
+
+    with transaction.atomic():
+        existing = set()
+        for notebook_id, fields in totals.items():
+            updates = {field: F(field) + count for field, count in fields.items()}
+            if Notebook.objects.filter(pk=notebook_id).update(**updates):
+                existing.add(notebook_id)
+
+        # Skip usage rows for notebooks deleted since the increment
+        for (notebook_id, day), fields in daily.items():
+            if notebook_id in existing:
+                _add_daily_usage(notebook_id, day, dict(fields))
+
+        # Mark the journals as applied, committed or rolled back along with their counts
+        CounterBatch.objects.bulk_create([CounterBatch(name=name) for name in batches])
+
+
+def _forget_batches(names):
+    # Once the journals are removed they can't be replayed, and their names are never reused
+    try:
+        CounterBatch.objects.filter(name__in=names).delete()
+    except Exception as e:
+        logger.error("Unable to remove applied counter journals: " + str(e))
+
+
+# Shared instance used by the views
+counter_service = CounterService()
@@ -0,0 +1,144 @@
+import gzip
+import os
+import re
+import shutil
+import uuid
+
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+
+try:
+    import brotli  # Optional, brotli variants are only created if the module is installed
+except ImportError:
+    brotli = None
+
+
+# Content encodings that can be stored next to a published notebook, in order of preference
+VARIANTS = (('br', '.br'), ('gzip', '.gz'))
+
+CONTENT_TYPE = 'application/x-ipynb+json'
+
+
+def _write_atomic(path, write):
+    temp = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+    with open(temp, 'wb') as f:
+        write(f)
+    os.replace(temp, path)
+
+
+def precompress(path):
+    """
+    Store gzip (and, if available, brotli) encoded copies of the file next to it
+    """
+    def write_gzip(f):
+        with open(path, 'rb') as src, gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as dst:
+            shutil.copyfileobj(src, dst)
+    _write_atomic(path + '.gz', write_gzip)
+
+    if brotli is not None:
+        with open(path, 'rb') as src:
+            data = brotli.compress(src.read())
+        _write_atomic(path + '.br', lambda f: f.write(data))
+
+
+def _accepted_encodings(request):
+    # Parse Accept-Encoding into the set of encodings with a non-zero quality
+    accepted = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        quality = 1.0
+        for param in fields[1:]:
+            if param.strip().startswith('q='):
+                try:
+                    quality = float(param.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def _choose_variant(request, path):
+    """
+    Return the (encoding, path) to serve, lazily compressing notebooks published before
+    precompression was added or whose variants are older than the file
+    """
+    accepted = _accepted_encodings(request)
+    source_mtime = os.stat(path).st_mtime
+    for encoding, suffix in VARIANTS:
+        if encoding not in accepted and '*' not in accepted:
+            continue
+        if encoding == 'br' and brotli is None:
+            continue
+        variant = path + suffix
+        if not os.path.exists(variant) or os.stat(variant).st_mtime < source_mtime:
+            precompress(path)
+        return encoding, variant
+    return None, path
+
+
+def _parse_range(header, size):
+    # Support a single byte range, return (start, end) inclusive, or None if unsatisfiable
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+    else:
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    end = min(end, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+def serve_notebook(request, path, filename):
+    """
+    Serve a notebook file as an attachment, choosing a precompressed variant by
+    Accept-Encoding and supporting conditional and single byte range requests
+    """
+    encoding, variant = _choose_variant(request, path)
+    stat = os.stat(variant)
+    etag = '"%x-%x%s"' % (int(stat.st_mtime), stat.st_size, '-' + encoding if encoding else '')
+    last_modified = http_date(stat.st_mtime)
+
+    def add_headers(response):
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        response['Vary'] = 'Accept-Encoding'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    # Conditional requests
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if (if_none_match and etag in [t.strip() for t in if_none_match.split(',')]) or \
+            (not if_none_match and if_modified_since and int(stat.st_mtime) <= if_modified_since):
+        return add_headers(HttpResponseNotModified())
+
+    # Range requests, ignored if If-Range names a different version of the file
+    range_header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if range_header and (not if_range or if_range in (etag, last_modified)):
+        byte_range = _parse_range(range_header, stat.st_size)
+        if byte_range is None:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % stat.st_size
+            return add_headers(response)
+
+        start, end = byte_range
+        with open(variant, 'rb') as f:
+            f.seek(start)
+            response = HttpResponse(f.read(end - start + 1), status=206, content_type=CONTENT_TYPE)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+    else:
+        response = FileResponse(open(variant, 'rb'), content_type=CONTENT_TYPE)
+        response['Content-Length'] = str(stat.st_size)
+
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return add_headers(response)
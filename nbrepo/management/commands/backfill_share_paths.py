@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from nbrepo.sharing import Share
+
+
+class Command(BaseCommand):
+    help = 'Fill in the owner and path lookup columns of shares created before they were added'
+
+    def handle(self, *args, **options):
+        count = 0
+        for share in Share.objects.filter(owner_username=''):
+            owner_username, _, path = share.api_path.partition('/')
+            Share.objects.filter(id=share.id).update(owner_username=owner_username, path=path)
+            count += 1
+
+        self.stdout.write('Updated %d shares' % count)
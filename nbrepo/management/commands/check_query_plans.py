@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from nbrepo.models import Collaborator, Notebook, RosterMember, Share, Tag, Webtour
+
+
+def hot_queries():
+    """
+    The lookups made by the sharing and repository views on every request, built the same
+    way as in the views, with placeholder values
+    """
+    return [
+        ('copy_share, accept, decline, revisions', Collaborator.objects.filter(user='user', share_id=1)),
+        ('shared_with_me', Collaborator.objects.filter(user='user', declined=False)),
+        ('editing_heartbeat', Collaborator.objects.filter(user='user', file_path='path')),
+        ('collaborators?token=', Collaborator.objects.filter(token='token')),
+        ('current_collaborators', Collaborator.objects.filter(share__owner_username='user', share__path='path')),
+        ('begin_sharing', Share.objects.filter(api_path='user/path')),
+        ('roster membership', RosterMember.objects.filter(user='user')),
+        ('notebooks?owner=', Notebook.objects.filter(owner='user')),
+        ('notebooks?api_path=', Notebook.objects.filter(api_path='path')),
+        ('tag lookup', Tag.objects.filter(label__in=['a', 'b'])),
+        ('webtour_seen', Webtour.objects.filter(user='user')),
+    ]
+
+
+def full_scans(queryset):
+    # Return the tables the query reads without an index, SQLite reports these as "SCAN <table>"
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        details = [row[-1] for row in cursor.fetchall()]
+    return [d for d in details if d.startswith('SCAN') and 'INDEX' not in d]
+
+
+class Command(BaseCommand):
+    help = 'Fail if any of the hot lookups is planned as a full table scan'
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Query plans can only be checked on SQLite')
+
+        failures = []
+        for name, queryset in hot_queries():
+            scans = full_scans(queryset)
+            if scans:
+                failures.append(name + ': ' + '; '.join(scans))
+            elif options['verbosity'] > 1:
+                self.stdout.write('OK ' + name)
+
+        if failures:
+            raise CommandError('Full table scans in hot lookups:\n  ' + '\n  '.join(failures))
+        self.stdout.write('No full table scans in %d hot lookups' % len(hot_queries()))
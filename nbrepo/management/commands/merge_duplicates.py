@@ -0,0 +1,74 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from nbrepo.models import Collaborator, Notebook, Share, Tag
+
+
+class Command(BaseCommand):
+    help = 'Merge tags with the same label and shares with the same api_path. Run before migrating to their unique ' \
+           'indexes; it only reads and writes columns that exist before the migration, so it works on the old schema.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic(), connection.cursor() as cursor:
+            tags = self._merge_tags(cursor)
+            shares = self._merge_shares(cursor)
+
+        self.stdout.write('Merged %d tags and %d shares' % (tags, shares))
+
+    @staticmethod
+    def _duplicates(cursor, table, column):
+        # Map each duplicated value to its ids, lowest (the one kept) first
+        cursor.execute('SELECT %s, id FROM %s WHERE %s IN (SELECT %s FROM %s GROUP BY %s HAVING COUNT(*) > 1) ORDER BY id'
+                       % (column, table, column, column, table, column))
+        duplicates = {}
+        for value, id in cursor.fetchall():
+            duplicates.setdefault(value, []).append(id)
+        return duplicates.values()
+
+    @staticmethod
+    def _in(ids):
+        return '(' + ', '.join(['%s'] * len(ids)) + ')'
+
+    def _merge_tags(self, cursor):
+        tag_table = connection.ops.quote_name(Tag._meta.db_table)
+        through_table = connection.ops.quote_name(Notebook.tags.through._meta.db_table)
+        merged = 0
+        for ids in self._duplicates(cursor, tag_table, 'label'):
+            keep, others = ids[0], ids[1:]
+
+            # Point the notebooks of the duplicates at the tag being kept, dropping links it already has
+            cursor.execute('SELECT notebook_id FROM %s WHERE tag_id = %%s' % through_table, [keep])
+            tagged = {row[0] for row in cursor.fetchall()}
+            cursor.execute('SELECT id, notebook_id FROM %s WHERE tag_id IN %s' % (through_table, self._in(others)), others)
+            for link_id, notebook_id in cursor.fetchall():
+                if notebook_id in tagged:
+                    cursor.execute('DELETE FROM %s WHERE id = %%s' % through_table, [link_id])
+                else:
+                    cursor.execute('UPDATE %s SET tag_id = %%s WHERE id = %%s' % through_table, [keep, link_id])
+                    tagged.add(notebook_id)
+
+            cursor.execute('DELETE FROM %s WHERE id IN %s' % (tag_table, self._in(others)), others)
+            merged += len(others)
+        return merged
+
+    def _merge_shares(self, cursor):
+        share_table = connection.ops.quote_name(Share._meta.db_table)
+        collaborator_table = connection.ops.quote_name(Collaborator._meta.db_table)
+        user = connection.ops.quote_name('user')
+        merged = 0
+        for ids in self._duplicates(cursor, share_table, 'api_path'):
+            keep, others = ids[0], ids[1:]
+
+            # Move the collaborators the share being kept doesn't already have, remove the rest with the duplicates
+            cursor.execute('SELECT %s FROM %s WHERE share_id = %%s' % (user, collaborator_table), [keep])
+            existing = {row[0] for row in cursor.fetchall()}
+            cursor.execute('SELECT id, %s FROM %s WHERE share_id IN %s ORDER BY id' % (user, collaborator_table, self._in(others)), others)
+            for collaborator_id, username in cursor.fetchall():
+                if username not in existing:
+                    cursor.execute('UPDATE %s SET share_id = %%s WHERE id = %%s' % collaborator_table, [keep, collaborator_id])
+                    existing.add(username)
+
+            cursor.execute('DELETE FROM %s WHERE share_id IN %s' % (collaborator_table, self._in(others)), others)
+            cursor.execute('DELETE FROM %s WHERE id IN %s' % (share_table, self._in(others)), others)
+            merged += len(others)
+        return merged
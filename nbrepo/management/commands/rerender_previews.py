@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from nbrepo import settings
+from nbrepo.models import Notebook
+from nbrepo.preview import preview_is_current, render_hash, run_preview
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the previews of all notebooks, or of those with a tag or owner, skipping those already up to date. ' \
+           'Set PREVIEW_STYLE_VERSION to a new value after a theme or CSS change to make every preview out of date.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'PREVIEW_CONCURRENCY', 2),
+                            help='Number of previews to generate at once')
+        parser.add_argument('--tag', action='append', default=[], help='Only notebooks with this tag, may be repeated')
+        parser.add_argument('--owner', action='append', default=[], help='Only notebooks of this owner, may be repeated')
+        parser.add_argument('--force', action='store_true', help='Regenerate previews that are already up to date')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording the notebooks done so far, defaults to one in PREVIEW_QUEUE_PATH')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of an earlier run')
+
+    def handle(self, *args, **options):
+        notebooks = Notebook.objects.order_by('id')
+        if options['tag']:
+            notebooks = notebooks.filter(tags__label__in=options['tag']).distinct()
+        if options['owner']:
+            notebooks = notebooks.filter(owner__in=options['owner'])
+
+        # Resume from the checkpoint of an interrupted run with the same filters
+        run = {'tag': sorted(options['tag']), 'owner': sorted(options['owner']), 'force': options['force']}
+        checkpoint_path = options['checkpoint'] or os.path.join(getattr(settings, 'PREVIEW_QUEUE_PATH', './data/previews/'), 'rerender.checkpoint')
+        done = set() if options['restart'] else self._load_checkpoint(checkpoint_path, run)
+
+        todo = [nb for nb in notebooks if nb.id not in done]
+        total = len(todo) + len(done)
+        if done:
+            self.stdout.write('Resuming, %d of %d notebooks already done' % (len(done), total))
+
+        counts = {'rendered': 0, 'skipped': 0, 'failed': 0}
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {executor.submit(self._rerender, nb, options['force'], options['workers']): nb for nb in todo}
+            for future in as_completed(futures):
+                nb = futures[future]
+                result, seconds = future.result()
+                counts[result] += 1
+
+                # Failed notebooks are left out of the checkpoint, so that they are tried again on resume
+                if result != 'failed':
+                    done.add(nb.id)
+                    self._save_checkpoint(checkpoint_path, run, done)
+
+                self.stdout.write('[%d/%d] %s %s (%d): %s in %.1fs' % (
+                    len(done) + counts['failed'], total, nb.owner, nb.name, nb.id, result, seconds))
+
+        self.stdout.write('Rendered %d, skipped %d, failed %d in %.0fs' % (
+            counts['rendered'], counts['skipped'], counts['failed'], time.time() - started))
+
+        # Start the next run from the beginning, unless some notebooks still need to be retried
+        if not counts['failed'] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    @staticmethod
+    def _rerender(nb, force, slots):
+        start = time.time()
+        try:
+            rendered = render_hash(nb.file_path)
+            if not force and preview_is_current(nb, rendered):
+                return 'skipped', time.time() - start
+
+            # Clear the recorded hash when forced, so that run_preview doesn't consider the preview current
+            if force:
+                nb.preview_hash = ''
+                Notebook.objects.filter(id=nb.id).update(preview_hash='')
+
+            run_preview(nb, rendered, wait=True, slots=slots)
+            return ('rendered' if preview_is_current(nb, rendered) else 'failed'), time.time() - start
+        except Exception as e:
+            # Count any error as a failure of this notebook, so that the run goes on with the others
+            logger.error("Unable to rerender the preview of notebook " + str(nb.id) + ": " + str(e))
+            return 'failed', time.time() - start
+        finally:
+            # Worker threads open their own database connections, don't leak them
+            connection.close()
+
+    @staticmethod
+    def _load_checkpoint(path, run):
+        try:
+            with open(path, 'r') as f:
+                checkpoint = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return set()
+        return set(checkpoint['done']) if checkpoint.get('run') == run else set()
+
+    @staticmethod
+    def _save_checkpoint(path, run, done):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'run': run, 'done': sorted(done)}, f)
+        os.replace(path + '.tmp', path)
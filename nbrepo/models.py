@@ -4,11 +4,13 @@ from rest_framework.authtoken.models import Token
 from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .sharing import Collaborator, Share
+from .sharing import Collaborator, Roster, RosterMember, Share
+from .outbox import OutboxEmail
+from .revisions import ShareRevision
 
 
 class Tag(models.Model):
-    label = models.CharField(max_length=64)
+    label = models.CharField(max_length=64, unique=True)
     protected = models.BooleanField(default=False)
     weight = models.IntegerField(default=0)
     pinned = models.BooleanField(default=False)
@@ -23,9 +25,9 @@ class Notebook(models.Model):
 
     publication = models.DateField()
 
-    owner = models.CharField(max_length=128)
+    owner = models.CharField(max_length=128, db_index=True)
     file_path = models.CharField(max_length=256)
-    api_path = models.CharField(max_length=256)
+    api_path = models.CharField(max_length=256, db_index=True)
 
     weight = models.IntegerField(default=0)
     tags = models.ManyToManyField(Tag)
@@ -33,9 +35,66 @@ class Notebook(models.Model):
     copied = models.IntegerField(default=1)
     launched = models.IntegerField(default=1)
 
+    # SHA-256 of the published file, which is also its key in the blob store
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+
+    # Hash of the rendered content of the file the current preview was generated from
+    preview_hash = models.CharField(max_length=64, blank=True, default='')
+
+
+class Blob(models.Model):
+    # A file in the content-addressed blob store and the number of published files linked to it
+    digest = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    refcount = models.IntegerField(default=0)
+
+
+class NotebookUsage(models.Model):
+    # Launches and copies of a notebook on a single day
+    notebook = models.ForeignKey(Notebook, on_delete=models.CASCADE)
+    date = models.DateField()
+
+    copied = models.IntegerField(default=0)
+    launched = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('notebook', 'date')
+
+
+class CounterBatch(models.Model):
+    # A counter journal already applied to the database, so that it isn't applied twice
+    name = models.CharField(max_length=64, unique=True)
+
+
+class PublishJob(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETE = 'complete'
+    ERROR = 'error'
+
+    CREATE = 'create'
+    UPDATE = 'update'
+
+    notebook = models.ForeignKey(Notebook, on_delete=models.SET_NULL, null=True)
+    action = models.CharField(max_length=16)
+    status = models.CharField(max_length=16, default=QUEUED)
+    step = models.CharField(max_length=32, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+
+    # URL of the notebook's API endpoint, inserted into the published file's metadata
+    repository_url = models.CharField(max_length=256, blank=True, default='')
+
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class CatalogVersion(models.Model):
+    # Single row counter, incremented whenever the published catalog or its tags change
+    version = models.IntegerField(default=0)
+
 
 class Webtour(models.Model):
-    user = models.CharField(max_length=128)
+    user = models.CharField(max_length=128, db_index=True)
     seen = models.BooleanField(default=False)
 
 
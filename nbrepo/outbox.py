@@ -0,0 +1,219 @@
+import logging
+import os
+import smtplib
+import threading
+import uuid
+from datetime import timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from django.conf import settings
+from django.conf.urls import url
+from django.db import connection, models, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from rest_framework import permissions
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+##################
+# From models.py #
+##################
+
+
+class OutboxEmail(models.Model):
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    from_email = models.CharField(max_length=128)
+    to_email = models.TextField()                   # Comma separated list of recipients
+    subject = models.CharField(max_length=256)
+    message = models.TextField()                    # HTML body
+
+    status = models.CharField(max_length=16, default=PENDING)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+
+    # Set while a sender is delivering the email, so that only one worker sends it
+    claim_token = models.CharField(max_length=32, blank=True, default='')
+    claimed_at = models.DateTimeField(null=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (('status', 'next_attempt'),)
+
+    def __str__(self):
+        return self.subject + ' (' + self.to_email + ')'
+
+
+############
+# Delivery #
+############
+
+
+_wake = threading.Event()
+_sender_pid = None
+
+
+def start_sender():
+    """
+    Start the background sender of this process, if it is not already running
+    """
+    global _sender_pid
+
+    # Start one sender thread in each process, so that forked web workers get their own
+    if _sender_pid != os.getpid():
+        _sender_pid = os.getpid()
+        threading.Thread(target=_sender_loop, name='outbox-sender', daemon=True).start()
+
+
+def queue_email(from_email, to_email, subject, message):
+    """
+    Add an email to the outbox and return at once, it is sent by a background sender
+    once the current transaction commits
+    """
+    email = OutboxEmail.objects.create(from_email=from_email, to_email=to_email, subject=subject, message=message)
+    start_sender()
+    transaction.on_commit(_wake.set)
+    return email
+
+
+def _sender_loop():
+    while True:
+        _wake.wait(getattr(settings, 'OUTBOX_POLL_INTERVAL', 30))
+        _wake.clear()
+        try:
+            while deliver_pending():
+                pass
+        except Exception as e:
+            logger.error("Unable to deliver queued email: " + str(e))
+        finally:
+            connection.close()
+
+
+def _claim_batch():
+    now = timezone.now()
+
+    # Release emails claimed by a sender that exited before finishing
+    OutboxEmail.objects.filter(status=OutboxEmail.SENDING,
+                               claimed_at__lt=now - timedelta(seconds=getattr(settings, 'OUTBOX_CLAIM_TIMEOUT', 600))) \
+        .update(status=OutboxEmail.PENDING, claim_token='')
+
+    # Claim the next batch of due emails
+    token = uuid.uuid4().hex
+    due = OutboxEmail.objects.filter(status=OutboxEmail.PENDING, next_attempt__lte=now) \
+        .order_by('next_attempt').values_list('id', flat=True)[:getattr(settings, 'OUTBOX_BATCH_SIZE', 50)]
+    OutboxEmail.objects.filter(id__in=list(due), status=OutboxEmail.PENDING) \
+        .update(status=OutboxEmail.SENDING, claim_token=token, claimed_at=now)
+    return list(OutboxEmail.objects.filter(claim_token=token, status=OutboxEmail.SENDING))
+
+
+def _connect():
+    server = smtplib.SMTP(settings.EMAIL_SERVER, 25)
+    if hasattr(settings, 'EMAIL_USERNAME'):
+        server.login(settings.EMAIL_USERNAME, settings.EMAIL_PASSWORD)
+    return server
+
+
+def _mark_failed(email, error):
+    # Retry with exponential backoff, until the maximum number of attempts
+    email.attempts += 1
+    email.last_error = str(error)
+    email.claim_token = ''
+    if email.attempts >= getattr(settings, 'OUTBOX_MAX_ATTEMPTS', 8):
+        email.status = OutboxEmail.FAILED
+    else:
+        email.status = OutboxEmail.PENDING
+        delay = min(getattr(settings, 'OUTBOX_RETRY_DELAY', 30) * 2 ** (email.attempts - 1), 6 * 60 * 60)
+        email.next_attempt = timezone.now() + timedelta(seconds=delay)
+    email.save()
+
+
+def deliver_pending():
+    """
+    Send one batch of due emails over a single SMTP session. Returns the number of
+    emails attempted, so that the caller can keep going until the outbox is drained.
+    """
+    batch = _claim_batch()
+    if not batch:
+        return 0
+
+    server = None
+    try:
+        server = _connect()
+    except Exception as e:
+        for email in batch:
+            _mark_failed(email, e)
+        return 0
+
+    for email in batch:
+        try:
+            msg = MIMEMultipart()
+            msg['From'] = email.from_email
+            msg['To'] = email.to_email
+            msg['Subject'] = email.subject
+            msg.attach(MIMEText(email.message, 'html'))
+            try:
+                server.sendmail(email.from_email, email.to_email.split(', '), msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                server = _connect()  # Reconnect once if the server dropped the session
+                server.sendmail(email.from_email, email.to_email.split(', '), msg.as_string())
+
+            email.status = OutboxEmail.SENT
+            email.sent_at = timezone.now()
+            email.claim_token = ''
+            email.save()
+        except Exception as e:
+            _mark_failed(email, e)
+
+    try:
+        server.quit()
+    except smtplib.SMTPException:
+        pass
+
+    return len(batch)
+
+
+#################
+# From views.py #
+#################
+
+
+@api_view(['GET'])
+@permission_classes((permissions.AllowAny,))
+def outbox_status(request):
+    # Count the emails in each state with a single aggregate query
+    counts = {OutboxEmail.PENDING: 0, OutboxEmail.SENDING: 0, OutboxEmail.SENT: 0, OutboxEmail.FAILED: 0}
+    for row in OutboxEmail.objects.values('status').annotate(count=Count('id')):
+        counts[row['status']] = row['count']
+
+    # Report how long the oldest unsent email has been waiting
+    oldest = OutboxEmail.objects.filter(status__in=(OutboxEmail.PENDING, OutboxEmail.SENDING)).aggregate(oldest=Min('created'))['oldest']
+
+    return Response({
+        'depth': counts[OutboxEmail.PENDING] + counts[OutboxEmail.SENDING],
+        'counts': counts,
+        'retrying': OutboxEmail.objects.filter(status=OutboxEmail.PENDING, attempts__gt=0).count(),
+        'oldest_pending': str(oldest) if oldest else None,
+    })
+
+
+################
+# From urls.py #
+################
+
+
+urlpatterns = [
+    url(r'^services/sharing/outbox/$', outbox_status),
+]
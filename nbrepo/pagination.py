@@ -0,0 +1,118 @@
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination for tables without a natural sort order. Each page is
+    fetched with an indexed seek on the primary key instead of an OFFSET.
+    """
+    ordering = ('id',)
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        # CursorPagination ignores page_size_query_param and max_page_size, honor them here
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(page_size, self.max_page_size) if page_size > 0 else self.page_size
+
+
+class WeightCursorPagination(IdCursorPagination):
+    """
+    Keyset pagination for the catalog tables (notebooks and tags), ordered by
+    their display weight and then by id so that ties have a stable order.
+
+    CursorPagination only seeks on the first ordering field and skips over ties
+    with an OFFSET, which is capped, so long runs of equal weights can't be paged
+    through. Here the cursor holds every ordering field, which together are unique,
+    and each page seeks past the whole (weight, id) position instead.
+    """
+    ordering = ('weight', 'id')
+
+    def _get_position_from_instance(self, instance, ordering):
+        return json.dumps([getattr(instance, field.lstrip('-')) for field in ordering])
+
+    def _seek(self, position, reverse):
+        # Rows after the position in the ordering, or before it when reversed:
+        # a > x OR (a = x AND b > y) ..., bounded on the first field so it uses the index
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        after = None
+        equal = {}
+        for field, value in zip(self.ordering, values):
+            attr = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') != reverse else '__gt'
+            step = Q(**dict(equal, **{attr + lookup: value}))
+            after = step if after is None else after | step
+            equal[attr] = value
+
+        first = self.ordering[0]
+        bound = '__lte' if first.startswith('-') != reverse else '__gte'
+        return Q(**{first.lstrip('-') + bound: values[0]}) & after
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # CursorPagination.paginate_queryset, seeking on the whole position instead of its first field
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        if reverse:
+            queryset = queryset.order_by(*[f[1:] if f.startswith('-') else '-' + f for f in self.ordering])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+
+        if current_position is not None:
+            queryset = queryset.filter(self._seek(current_position, reverse))
+
+        # Fetch an extra item to know if there is a following page
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import time
+import urllib.parse
+
+from django.conf import settings
+
+
+def _presence_dir():
+    # Default to shared memory, so that heartbeats never touch the disk or the database
+    default_base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return getattr(settings, 'PRESENCE_PATH', None) or os.path.join(default_base, 'nbrepo-presence')
+
+
+def _share_dir(share_id):
+    return os.path.join(_presence_dir(), str(int(share_id)))
+
+
+def _ttl():
+    return getattr(settings, 'PRESENCE_TTL', 60)
+
+
+def heartbeat(share_id, username):
+    """
+    Mark the user as currently editing the shared notebook. Presence is kept as one file
+    per user and share in a directory shared by all workers, whose mtime is the time of
+    the last heartbeat and whose content is the time last_accessed was written to the
+    database. Returns True if the database copy is older than PRESENCE_PERSIST_INTERVAL
+    and should be written again.
+    """
+    share_dir = _share_dir(share_id)
+    os.makedirs(share_dir, exist_ok=True)
+    path = os.path.join(share_dir, urllib.parse.quote(username, safe=''))
+    now = time.time()
+
+    try:
+        with open(path, 'r') as f:
+            persisted = float(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        persisted = 0
+
+    if now - persisted >= getattr(settings, 'PRESENCE_PERSIST_INTERVAL', 600):
+        with open(path, 'w') as f:
+            f.write(str(now))
+        return True
+
+    try:
+        os.utime(path, (now, now))
+    except FileNotFoundError:
+        # Removed as expired by editors() since it was read, recreate it
+        with open(path, 'w') as f:
+            f.write(str(persisted))
+    return False
+
+
+def editors(share_id, exclude=None):
+    """
+    Return the sorted list of users with a heartbeat on the share within PRESENCE_TTL
+    seconds, dropping expired entries along the way
+    """
+    share_dir = _share_dir(share_id)
+    cutoff = time.time() - _ttl()
+    current = []
+    try:
+        entries = os.listdir(share_dir)
+    except FileNotFoundError:
+        return current
+
+    for entry in entries:
+        path = os.path.join(share_dir, entry)
+        try:
+            if os.stat(path).st_mtime >= cutoff:
+                username = urllib.parse.unquote(entry)
+                if username != exclude:
+                    current.append(username)
+            elif os.stat(path).st_mtime < cutoff - _ttl():
+                os.remove(path)  # Long expired, remove it
+        except FileNotFoundError:
+            continue
+
+    return sorted(current)
+
+
+def wait_for_change(share_id, known, exclude=None, timeout=5):
+    """
+    Block until the list of editors differs from the known list, or until the timeout,
+    and return the current list of editors. This holds a web worker, so keep the timeout short.
+    """
+    deadline = time.time() + timeout
+    known = set(known)
+    current = editors(share_id, exclude)
+    while set(current) == known and time.time() < deadline:
+        time.sleep(getattr(settings, 'PRESENCE_POLL_INTERVAL', 1))
+        current = editors(share_id, exclude)
+    return current
@@ -1,8 +1,20 @@
+import fcntl
+import hashlib
+import json
+import logging
 import os
+import re
 import shlex
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from django.db import connection
 from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, redirect
 from django.template import loader
 from django.views.static import serve
 from rest_framework import permissions
@@ -10,10 +22,173 @@ from rest_framework.decorators import api_view, permission_classes
 from nbrepo import settings
 from nbrepo.models import Notebook
 
+try:
+    from PIL import Image  # Optional, preview sizes and formats are only generated if Pillow is installed
+except ImportError:
+    Image = None
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# Widths of the preview sizes, each a scaled copy of the full page screenshot, and the formats they are saved in
+PREVIEW_SIZES = (('thumb', 300), ('card', 600), ('full', 1200))
+PREVIEW_FORMATS = (('webp', 'WEBP'), ('png', 'PNG'))
+WEBP_MAX_DIMENSION = 16383
+
+# The manifest lists the current preview files, which are named by the hash of the screenshot
+MANIFEST_NAME = 'preview.json'
+VARIANT_NAME = re.compile(r'^preview-(thumb|card|full)-[0-9a-f]+\.(webp|png)$')
+
+# Shown in place of a preview that is still being generated
+PLACEHOLDER_SVG = """<svg xmlns="http://www.w3.org/2000/svg" width="1200" height="900" viewBox="0 0 1200 900">
+<rect width="1200" height="900" fill="#f5f5f5"/>
+<text x="600" y="450" font-family="Helvetica, Arial, sans-serif" font-size="36" fill="#999" text-anchor="middle">Generating Notebook Preview</text>
+</svg>"""
+
+
+def _low_priority_prefix():
+    # Run captures at the lowest CPU and IO priority, so they don't slow down the web workers
+    prefix = ''
+    if shutil.which('nice'):
+        prefix += 'nice -n 19 '
+    if shutil.which('ionice'):
+        prefix += 'ionice -c 3 '
+    return prefix
+
+
+def _request_screenshot(nb_file_path, output):
+    # Send the job to the screenshot service and wait for it to finish, allowing for time waiting on a free page
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(getattr(settings, 'SCREENSHOT_TIMEOUT', 180) * 2)
+        sock.connect(getattr(settings, 'SCREENSHOT_SOCKET', '/tmp/nbrepo-screenshot.sock'))
+        request = {'path': os.path.abspath(nb_file_path), 'renderer': getattr(settings, 'PREVIEW_RENDERER', 'hub'),
+                   'output': os.path.abspath(output)}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as reply:
+            return json.loads(reply.readline().decode('utf-8'))
+
 
 def generate_preview(nb_file_path):
-    # Generate the preview screenshot and save it to the preview directory
-    os.system("/srv/notebook-repository/nbrepo/screenshot.py " + shlex.quote(nb_file_path))
+    """
+    Generate the preview screenshot with the screenshot service and save it to the preview directory.
+    The screenshot is taken to a temporary file, which only replaces the current preview once the
+    capture succeeds, so a failed capture leaves the last good preview in place. Returns whether it succeeded.
+    """
+    dir = os.path.dirname(nb_file_path)
+    temp = os.path.join(dir, 'preview.' + uuid.uuid4().hex[:8] + '.tmp.png')
+    try:
+        try:
+            result = _request_screenshot(nb_file_path, temp)
+            if result.get('error'):
+                logger.error("Unable to generate preview of " + nb_file_path + ": " + result['error'])
+                return False
+
+        # If the service is not running, take the screenshot in a new process
+        except (FileNotFoundError, ConnectionRefusedError):
+            os.system(_low_priority_prefix() + "/srv/notebook-repository/nbrepo/screenshot.py " + shlex.quote(nb_file_path) + " " +
+                      shlex.quote(getattr(settings, 'PREVIEW_RENDERER', 'hub')) + " " + shlex.quote(temp))
+        except (OSError, ValueError) as e:
+            logger.error("Unable to generate preview of " + nb_file_path + ": " + str(e))
+            return False
+
+        if not os.path.exists(temp):
+            return False
+        os.replace(temp, os.path.join(dir, 'preview.png'))
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+    # Save the smaller sizes and formats of the screenshot
+    try:
+        build_variants(nb_file_path)
+    except (OSError, ValueError) as e:
+        logger.error("Unable to resize preview of " + nb_file_path + ": " + str(e))
+    return True
+
+
+def _save_atomic(image, path, image_format, **params):
+    temp = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+    image.save(temp, image_format, **params)
+    os.replace(temp, path)
+
+
+def build_variants(nb_file_path):
+    """
+    Save each preview size in each format, named by the hash of the screenshot so that the URL
+    of a file never changes content, list them in the manifest and remove the files of earlier
+    screenshots. Returns the manifest, or None if Pillow is not installed or there is no screenshot.
+    """
+    dir = os.path.dirname(nb_file_path)
+    screenshot_path = os.path.join(dir, 'preview.png')
+    if Image is None or not os.path.exists(screenshot_path):
+        return None
+
+    with open(screenshot_path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+
+    manifest = {'hash': digest, 'images': {}}
+    with Image.open(screenshot_path) as screenshot:
+        screenshot = screenshot.convert('RGB')
+        for size, width in PREVIEW_SIZES:
+            width = min(width, screenshot.width)
+            height = max(round(screenshot.height * width / screenshot.width), 1)
+            image = screenshot if width == screenshot.width else screenshot.resize((width, height), Image.LANCZOS)
+
+            entry = {'width': width, 'height': height}
+            for ext, image_format in PREVIEW_FORMATS:
+                if ext == 'webp' and max(width, height) > WEBP_MAX_DIMENSION:
+                    continue  # Too long a page for WebP, only PNG is available
+                name = 'preview-%s-%s.%s' % (size, digest, ext)
+                if not os.path.exists(os.path.join(dir, name)):
+                    _save_atomic(image, os.path.join(dir, name), image_format, **({'quality': 80} if ext == 'webp' else {'optimize': True}))
+                entry[ext] = name
+            manifest['images'][size] = entry
+
+    with open(os.path.join(dir, MANIFEST_NAME + '.tmp'), 'w') as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(dir, MANIFEST_NAME + '.tmp'), os.path.join(dir, MANIFEST_NAME))
+
+    # Remove the files of earlier screenshots
+    current = {name for entry in manifest['images'].values() for name in (entry.get('webp'), entry.get('png'))}
+    for name in os.listdir(dir):
+        if VARIANT_NAME.match(name) and name not in current:
+            os.remove(os.path.join(dir, name))
+
+    return manifest
+
+
+def load_manifest(nb_file_path):
+    try:
+        with open(os.path.join(os.path.dirname(nb_file_path), MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def render_hash(nb_file_path):
+    """
+    Hash the parts of a notebook that appear in its preview: the cells and their outputs.
+    Notebook metadata, such as the repository URL or kernel info, is left out.
+    """
+    with open(nb_file_path, 'r') as nb_file:
+        nb_json = json.load(nb_file)
+
+    rendered = [{'cell_type': cell.get('cell_type'),
+                 'source': cell.get('source'),
+                 'outputs': cell.get('outputs'),
+                 'execution_count': cell.get('execution_count')} for cell in nb_json.get('cells', [])]
+
+    # Changing PREVIEW_STYLE_VERSION after a theme or CSS change makes every preview out of date
+    style_version = getattr(settings, 'PREVIEW_STYLE_VERSION', '')
+    if style_version:
+        rendered = {'style': style_version, 'cells': rendered}
+
+    return hashlib.sha256(json.dumps(rendered, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def preview_exists(nb_file_path):
+    return os.path.exists(os.path.join(os.path.dirname(nb_file_path), 'preview.png'))
 
 
 def remove_preview(nb_file_path):
@@ -22,6 +197,208 @@ def remove_preview(nb_file_path):
     if os.path.exists(img):
         os.remove(img)
 
+    # Remove the sizes and formats and their manifest
+    if os.path.isdir(dir):
+        for name in os.listdir(dir):
+            if VARIANT_NAME.match(name) or name == MANIFEST_NAME:
+                os.remove(os.path.join(dir, name))
+
+
+#################
+# Preview queue #
+#################
+
+
+_pending = set()
+_pending_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    # Lazily create the pool in each process, so that forked web workers get their own
+    if _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PREVIEW_CONCURRENCY', 2))
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def _lock_path(name):
+    queue_path = getattr(settings, 'PREVIEW_QUEUE_PATH', './data/previews/')
+    os.makedirs(queue_path, exist_ok=True)
+    return os.path.join(queue_path, name + '.lock')
+
+
+def _try_lock(name, wait):
+    # Return the open lock file once locked, or None if another process holds it and not waiting
+    lock_file = open(_lock_path(name), 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        return lock_file
+    except BlockingIOError:
+        lock_file.close()
+        return None
+
+
+def _acquire_slot(slots=None):
+    # Wait for one of the PREVIEW_CONCURRENCY capture slots shared by every worker process
+    while True:
+        for i in range(slots or getattr(settings, 'PREVIEW_CONCURRENCY', 2)):
+            slot = _try_lock('slot-' + str(i), wait=False)
+            if slot is not None:
+                return slot
+        time.sleep(0.5)
+
+
+def _failures_path(notebook):
+    return _lock_path('notebook-' + str(notebook.id))[:-len('.lock')] + '.failures'
+
+
+def _load_failures(notebook, rendered):
+    # Return the number of failed captures of the notebook's rendered content and the time of the last one
+    try:
+        with open(_failures_path(notebook), 'r') as f:
+            failures = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return 0, 0
+    if failures.get('hash') != rendered:
+        return 0, 0
+    return failures['count'], failures['last']
+
+
+def _record_failure(notebook, rendered):
+    # Called with the notebook's lock held, so there's a single writer
+    count, _ = _load_failures(notebook, rendered)
+    path = _failures_path(notebook)
+    temp_path = path + '.' + uuid.uuid4().hex[:8]
+    with open(temp_path, 'w') as f:
+        json.dump({'hash': rendered, 'count': count + 1, 'last': time.time()}, f)
+    os.replace(temp_path, path)
+
+
+def _clear_failures(notebook):
+    try:
+        os.remove(_failures_path(notebook))
+    except FileNotFoundError:
+        pass
+
+
+def preview_is_current(notebook, rendered):
+    return rendered == notebook.preview_hash and preview_exists(notebook.file_path)
+
+
+def run_preview(notebook, rendered, wait=True, slots=None):
+    """
+    Generate the preview of the notebook's rendered content, unless it already exists. Only one
+    worker process generates the preview of a notebook at a time, the others wait for it if
+    wait is set or skip it otherwise, and at most PREVIEW_CONCURRENCY (or slots) captures run at once.
+    """
+    notebook_lock = _try_lock('notebook-' + str(notebook.id), wait)
+    if notebook_lock is None:
+        return  # Another worker is generating this preview
+
+    try:
+        # Another worker may have generated it while this one waited
+        notebook.preview_hash = Notebook.objects.filter(id=notebook.id).values_list('preview_hash', flat=True).first() or ''
+        if preview_is_current(notebook, rendered):
+            return
+
+        slot = _acquire_slot(slots)
+        succeeded = False
+        try:
+            succeeded = generate_preview(notebook.file_path)
+        finally:
+            slot.close()
+            if not succeeded:
+                _record_failure(notebook, rendered)
+
+        # Only record the content as previewed if the capture succeeded, so that it's tried again
+        if not succeeded:
+            return
+        notebook.preview_hash = rendered
+        Notebook.objects.filter(id=notebook.id).update(preview_hash=rendered)
+        _clear_failures(notebook)
+    finally:
+        notebook_lock.close()
+
+
+def _run_queued(notebook, rendered):
+    try:
+        run_preview(notebook, rendered, wait=False)
+    except Exception as e:
+        logger.error("Unable to generate preview of notebook " + str(notebook.id) + ": " + str(e))
+    finally:
+        with _pending_lock:
+            _pending.discard((notebook.id, rendered))
+
+        # Worker threads open their own database connections, don't leak them
+        connection.close()
+
+
+def queue_preview(notebook, rendered):
+    """
+    Generate the preview in the background, merging requests for the same notebook and content
+    """
+    key = (notebook.id, rendered)
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+    _get_executor().submit(_run_queued, notebook, rendered)
+
+
+def _placeholder_response(retry_after=None):
+    # Tell the client to try again shortly
+    response = HttpResponse(PLACEHOLDER_SVG, content_type='image/svg+xml', status=202)
+    response['Retry-After'] = str(int(retry_after or getattr(settings, 'PREVIEW_RETRY_AFTER', 5)))
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def _request_preview(notebook, rendered):
+    """
+    Queue the preview of the notebook's rendered content and return the placeholder response. After
+    a failed capture, wait PREVIEW_FAILURE_BACKOFF seconds before trying again, doubling each time,
+    and return None once PREVIEW_MAX_FAILURES captures of the same content have failed.
+    """
+    count, last = _load_failures(notebook, rendered)
+    if count >= getattr(settings, 'PREVIEW_MAX_FAILURES', 3):
+        return None
+
+    wait = 0
+    if count:
+        wait = getattr(settings, 'PREVIEW_FAILURE_BACKOFF', 60) * 2 ** (count - 1) - (time.time() - last)
+    if wait <= 0:
+        queue_preview(notebook, rendered)
+    return _placeholder_response(max(wait, getattr(settings, 'PREVIEW_RETRY_AFTER', 5)))
+
+
+def _variant_url(notebook, name):
+    return '/services/sharing/notebooks/' + str(notebook.id) + '/preview/' + name
+
+
+def _preview_images(notebook):
+    # The srcset attributes for the preview sizes, if they have been generated
+    manifest = load_manifest(notebook.file_path)
+    if manifest is None:
+        return None
+
+    images = manifest['images']
+
+    def srcset(ext):
+        return ', '.join('%s %dw' % (_variant_url(notebook, images[size][ext]), images[size]['width'])
+                         for size, _ in PREVIEW_SIZES if ext in images[size])
+
+    return {
+        'webp_srcset': srcset('webp'),
+        'png_srcset': srcset('png'),
+        'src': _variant_url(notebook, images['full']['png']),
+        'width': images['full']['width'],
+        'height': images['full']['height'],
+    }
+
 
 @api_view(['GET'])
 @permission_classes((permissions.AllowAny,))
@@ -32,7 +409,8 @@ def preview(request, pk):
     # Display the preview template
     template = loader.get_template('preview.html')
     context = {
-        'notebook': notebook
+        'notebook': notebook,
+        'images': _preview_images(notebook),
     }
     return HttpResponse(template.render(context, request))
 
@@ -41,13 +419,56 @@ def preview(request, pk):
 @permission_classes((permissions.AllowAny,))
 def preview_image(request, pk):
     # Get the notebook model
-    notebook = Notebook.objects.get(pk=pk)
+    notebook = get_object_or_404(Notebook, pk=pk)
+
+    # Lazily generate the screenshot in the background, if necessary, showing a placeholder until it's ready.
+    # Outside of JupyterHub the notebook may change without being republished, so check its content too.
+    # Once the capture has failed too often, stop retrying and report the error. The notebook's file
+    # may not be in place yet while the notebook is being published, if so it's not ready either.
+    if not preview_exists(notebook.file_path):
+        try:
+            rendered = render_hash(notebook.file_path)
+        except (OSError, ValueError):
+            return _placeholder_response()
+        response = _request_preview(notebook, rendered)
+        if response is None:
+            return HttpResponse('Unable to generate the preview of this notebook', status=500)
+        return response
+    if not settings.JUPYTERHUB:
+        try:
+            rendered = render_hash(notebook.file_path)
+        except (OSError, ValueError):
+            rendered = notebook.preview_hash  # Keep serving the current preview until the file is back
+        if rendered != notebook.preview_hash:
+            response = _request_preview(notebook, rendered)
+            if response is not None:
+                return response
+            # Otherwise keep serving the out of date preview
 
-    # Lazily generate screenshot and preview.html, if necessary
-    preview_path = os.path.join(os.path.dirname(notebook.file_path), 'preview.png')
-    if not os.path.exists(preview_path) or not settings.JUPYTERHUB:
-        generate_preview(notebook.file_path)
+    # If a size is requested, redirect to its immutable URL, in WebP if the client accepts it
+    size = request.GET.get('size')
+    manifest = load_manifest(notebook.file_path) if size else None
+    if manifest is not None and size in manifest['images']:
+        entry = manifest['images'][size]
+        ext = 'webp' if 'webp' in entry and 'image/webp' in request.META.get('HTTP_ACCEPT', '') else 'png'
+        response = redirect(_variant_url(notebook, entry[ext]))
+        response['Vary'] = 'Accept'
+        return response
 
     # Serve the file
     response = serve(request, 'preview.png', os.path.dirname(notebook.file_path))
     return response
+
+
+@api_view(['GET'])
+@permission_classes((permissions.AllowAny,))
+def preview_variant(request, pk, name):
+    # Get the notebook model
+    notebook = get_object_or_404(Notebook, pk=pk)
+
+    # Serve the file, its name changes whenever its content does, so it can be cached forever
+    response = serve(request, name, os.path.dirname(notebook.file_path))
+    if response.status_code == 200 and name.endswith('.webp'):
+        response['Content-Type'] = 'image/webp'
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
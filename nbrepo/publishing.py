@@ -0,0 +1,289 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from rest_framework import permissions
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from nbrepo.models import Notebook, PublishJob
+from nbrepo.serializers import PublishJobSerializer
+from . import blobstore
+from .downloads import precompress
+from .outbox import queue_email
+from .preview import preview_is_current, render_hash, run_preview
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+#####################
+# Publishing steps  #
+#####################
+
+
+def user_file_path(username, api_path):
+    base_user_path = os.path.join(settings.BASE_USER_PATH, username)
+    decoded_api_path = urllib.parse.unquote(api_path)
+
+    # Get the file path relative to the Jupyter server's home directory
+    file_path = re.search('/notebooks/(.+?)$', decoded_api_path).group(1)
+
+    # If named servers are enabled, get the server name
+    try:
+        named_server = re.search('/user/.*/(.+?)/notebooks/', decoded_api_path).group(1)
+    except AttributeError:
+        named_server = ''
+
+    # Path to the user's notebook file
+    user_nb_path = os.path.join(base_user_path, named_server, file_path)
+    return user_nb_path
+
+
+def repo_file_path(username, model_id, api_path):
+    # Get the file name
+    api_path_parts = api_path.split('/')
+    file_name = urllib.parse.unquote(api_path_parts[len(api_path_parts) - 1])
+
+    # Path to the repo's notebook file
+    return os.path.join(settings.BASE_REPO_PATH, username, str(model_id), file_name)
+
+
+def copy_to_file_path(username, model_id, api_path):
+    user_nb_path = user_file_path(username, api_path)
+    repo_nb_path = repo_file_path(username, model_id, api_path)
+
+    # Lazily create directories and copy the file, replacing rather than overwriting any
+    # previous version since it may be hardlinked to the blob store
+    if os.path.exists(user_nb_path):
+        blobstore.replace_file(user_nb_path, repo_nb_path)
+
+    return repo_nb_path
+
+
+def store_notebook(notebook):
+    """
+    Move the published file into the blob store, linking it back to its repository path,
+    and release the blob of the previously published version
+    """
+    previous = notebook.content_hash
+    notebook.content_hash = blobstore.intern(notebook.file_path)
+    Notebook.objects.filter(id=notebook.id).update(content_hash=notebook.content_hash)
+    blobstore.release(previous)
+
+
+def refresh_preview(notebook):
+    """
+    Regenerate the preview, unless it already shows the current rendered content
+    """
+    rendered = render_hash(notebook.file_path)
+    if preview_is_current(notebook, rendered):
+        return
+
+    # Generate it through the preview queue's locks, waiting for any capture of the same notebook
+    run_preview(notebook, rendered)
+
+
+def add_publish_metadata(nb_path, nb_url):
+    try:
+        with open(nb_path, 'r') as nb_read:
+            # Get the metadata
+            nb_json = json.load(nb_read)
+            nb_read.close()
+            nb_metadata = nb_json['metadata']
+
+            # Get the GenePattern metadata
+            if 'genepattern' not in nb_metadata:
+                nb_metadata['genepattern'] = {}
+            nb_genepattern = nb_metadata['genepattern']
+
+            # Set the repository_url
+            nb_genepattern['repository_url'] = nb_url
+
+            # Write back to the file
+            with open(nb_path, 'w') as nb_write:
+                json.dump(nb_json, nb_write)
+                nb_write.close()
+
+    except FileNotFoundError:
+        logger.error("Cannot open " + str(nb_path))
+    except KeyError:
+        logger.error("Cannot get metadata for " + str(nb_path))
+
+
+def send_publish_email(notebook):
+    if hasattr(settings, 'NOTIFICATION_EMAIL') and settings.NOTIFICATION_EMAIL:
+        fromaddr = "gp-info@broadinstitute.org"
+        preview = f"{settings.BASE_HUB_URL}/services/sharing/notebooks/{notebook.id}/preview/"
+        body = f"<p>A new notebook has been published to the notebook repository:</p>" + \
+               f"<p><a href='{preview}'>{preview}</a></p>"
+
+        # Queue the email in the outbox, it is delivered and retried in the background
+        queue_email(fromaddr, settings.NOTIFICATION_EMAIL, f"Notebook Published: {notebook.name}", body)
+
+
+##################
+# Job processing #
+##################
+
+
+def _set_step(job, step):
+    job.step = step
+    job.save(update_fields=['step', 'updated'])
+
+
+def _run_create(job, notebook):
+    # Copy the notebook to the file path
+    _set_step(job, 'copy')
+    copy_to_file_path(notebook.owner, notebook.id, notebook.api_path)
+
+    # Insert the publishing metadata in the notebook file
+    _set_step(job, 'metadata')
+    add_publish_metadata(user_file_path(notebook.owner, notebook.api_path), job.repository_url)  # Add to user's copy
+    add_publish_metadata(notebook.file_path, job.repository_url)                                 # Add to canonical copy
+
+    # Deduplicate the published file and store its compressed variants for downloads
+    _set_step(job, 'store')
+    store_notebook(notebook)
+    precompress(notebook.file_path)
+
+    # Generate the static preview
+    _set_step(job, 'preview')
+    refresh_preview(notebook)
+
+    # Send notification email
+    _set_step(job, 'email')
+    send_publish_email(notebook)
+
+
+def _run_update(job, notebook):
+    # Nothing to do if the user's file is the one already published, as for metadata-only edits
+    _set_step(job, 'hash')
+    user_nb_path = user_file_path(notebook.owner, notebook.api_path)
+    if os.path.exists(user_nb_path) and blobstore.file_digest(user_nb_path) == notebook.content_hash:
+        return
+
+    # Copy the notebook to the file path
+    _set_step(job, 'copy')
+    copy_to_file_path(notebook.owner, notebook.id, notebook.api_path)
+
+    # Deduplicate the published file and store its compressed variants for downloads
+    _set_step(job, 'store')
+    store_notebook(notebook)
+    precompress(notebook.file_path)
+
+    # Regenerate the static preview, if the rendered content changed
+    _set_step(job, 'preview')
+    refresh_preview(notebook)
+
+
+def run_job(job_id):
+    """
+    Run the publishing steps of a queued job. The job is claimed with a conditional
+    update, so a job submitted by more than one worker only runs once.
+    """
+    try:
+        if not PublishJob.objects.filter(id=job_id, status=PublishJob.QUEUED).update(status=PublishJob.RUNNING, updated=timezone.now()):
+            return
+
+        job = PublishJob.objects.get(id=job_id)
+        try:
+            notebook = Notebook.objects.get(id=job.notebook_id)
+            if job.action == PublishJob.CREATE:
+                _run_create(job, notebook)
+            else:
+                _run_update(job, notebook)
+
+            job.status = PublishJob.COMPLETE
+            job.step = ''
+        except Exception as e:
+            logger.error("Publish job " + str(job_id) + " failed during " + job.step + ": " + str(e))
+            job.status = PublishJob.ERROR
+            job.error = str(e)
+        job.save()
+
+    finally:
+        # Worker threads open their own database connections, don't leak them
+        connection.close()
+
+
+_executor = None
+_executor_pid = None
+
+
+def _get_executor():
+    global _executor, _executor_pid
+
+    # Lazily create the pool in each process, so that forked web workers get their own
+    if _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PUBLISH_WORKERS', 2))
+        _executor_pid = os.getpid()
+        _requeue_stale_jobs(_executor)
+
+        # Keep checking, so that jobs of a worker that dies later are picked up without a restart
+        threading.Thread(target=_requeue_loop, args=(_executor,), name='publish-requeue', daemon=True).start()
+    return _executor
+
+
+def _requeue_stale_jobs(executor):
+    # Pick up jobs left behind by a worker that exited before running or finishing them
+    now = timezone.now()
+    PublishJob.objects.filter(status=PublishJob.RUNNING,
+                              updated__lt=now - timedelta(seconds=getattr(settings, 'PUBLISH_JOB_TIMEOUT', 600))) \
+        .update(status=PublishJob.QUEUED, updated=now)
+    for job_id in PublishJob.objects.filter(status=PublishJob.QUEUED, updated__lt=now - timedelta(seconds=60)).values_list('id', flat=True):
+        executor.submit(run_job, job_id)
+
+
+def _requeue_loop(executor):
+    while True:
+        time.sleep(getattr(settings, 'PUBLISH_REQUEUE_INTERVAL', 60))
+        try:
+            _requeue_stale_jobs(executor)
+        except Exception as e:
+            logger.error("Unable to requeue stale publish jobs: " + str(e))
+        finally:
+            connection.close()
+
+
+def submit_publish_job(notebook, action, repository_url=''):
+    """
+    Queue the file copy, metadata, preview and email steps of a publish or update and
+    return the job, whose progress can be polled at /services/sharing/notebooks/jobs/<id>/
+    """
+    job = PublishJob.objects.create(notebook=notebook, action=action, repository_url=repository_url)
+    executor = _get_executor()
+    transaction.on_commit(lambda: executor.submit(run_job, job.id))
+    return job
+
+
+@api_view(['GET'])
+@permission_classes((permissions.IsAuthenticated,))
+def publish_status(request, pk):
+    # Get the job model
+    job = get_object_or_404(PublishJob, pk=pk)
+
+    # Only the owner of the notebook may follow its publishing
+    if job.notebook is None or job.notebook.owner != request.user.username:
+        return_obj = {"error": "Unable to view publishing job due to user permissions."}
+        return Response(return_obj, status=403)
+
+    # Polling a job also makes sure this process picks up jobs left behind by a dead worker
+    _get_executor()
+
+    # Return the job status, the details of a failure are only logged
+    data = PublishJobSerializer(job).data
+    if job.status == PublishJob.ERROR:
+        data['error'] = 'Publishing failed during the ' + job.step + ' step'
+    return Response(data)
@@ -0,0 +1,118 @@
+import gzip
+import hashlib
+import json
+import os
+import uuid
+
+from django.conf import settings
+from django.db import models
+
+
+##################
+# From models.py #
+##################
+
+
+class ShareRevision(models.Model):
+    share = models.ForeignKey('nbrepo.Share', on_delete=models.CASCADE, related_name='revisions')
+    number = models.IntegerField()                  # The share version this revision was saved as
+    created = models.DateTimeField(auto_now_add=True)
+    author = models.CharField(max_length=64)
+    content_hash = models.CharField(max_length=64)  # SHA-256 of the saved file
+
+    # The notebook without its cells (metadata, nbformat, ...) and the ordered list of cell hashes, as JSON
+    header = models.TextField()
+    cells = models.TextField()
+
+    class Meta:
+        unique_together = ('share', 'number')
+
+    def __str__(self):
+        return str(self.share) + ' (revision ' + str(self.number) + ')'
+
+
+##############
+# Cell store #
+##############
+
+
+def _cell_path(digest):
+    store_path = getattr(settings, 'REVISION_STORE_PATH', './data/revisions/')
+    return os.path.join(store_path, 'cells', digest[:2], digest + '.json.gz')
+
+
+def _canonical_cell(cell):
+    data = json.dumps(cell, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def _store_cell(cell):
+    """
+    Store a cell by the hash of its canonical JSON, if not already stored, and return the hash
+    """
+    data, digest = _canonical_cell(cell)
+    path = _cell_path(digest)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        with gzip.open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    return digest
+
+
+def _load_cell(digest):
+    with gzip.open(_cell_path(digest), 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def record_revision(share, nb_path, author):
+    """
+    Save the notebook at nb_path as a revision of the share, numbered by the share's current
+    version. Cells already stored by earlier revisions, of this or any share, are not stored
+    again, so a revision costs one row plus the cells that changed.
+    """
+    # Nothing to do if the latest revision already has this content
+    latest = share.revisions.order_by('-number').first()
+    if latest is not None and (latest.content_hash == share.content_hash or latest.number >= share.version):
+        return latest
+
+    with open(nb_path, 'r') as nb_file:
+        nb_json = json.load(nb_file)
+
+    cell_hashes = [_store_cell(cell) for cell in nb_json.pop('cells', [])]
+    return ShareRevision.objects.create(share=share, number=share.version, author=author,
+                                        content_hash=share.content_hash, header=json.dumps(nb_json),
+                                        cells=json.dumps(cell_hashes))
+
+
+def load_revision(revision):
+    """
+    Reassemble the notebook JSON of a revision from its header and stored cells
+    """
+    nb_json = json.loads(revision.header)
+    nb_json['cells'] = [_load_cell(digest) for digest in json.loads(revision.cells)]
+    return nb_json
+
+
+def matches_revision(revision, nb_path):
+    """
+    Whether the notebook at nb_path has the content of the revision, however its JSON is formatted
+    """
+    with open(nb_path, 'r') as nb_file:
+        nb_json = json.load(nb_file)
+
+    cell_hashes = [_canonical_cell(cell)[1] for cell in nb_json.pop('cells', [])]
+    return cell_hashes == json.loads(revision.cells) and nb_json == json.loads(revision.header)
+
+
+def write_revision(revision, nb_path):
+    """
+    Write the notebook of a revision to nb_path, formatted the way Jupyter saves notebooks
+    """
+    temp = nb_path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as nb_file:
+        nb_file.write(json.dumps(load_revision(revision), sort_keys=True, indent=1, ensure_ascii=False) + '\n')
+    os.replace(temp, nb_path)
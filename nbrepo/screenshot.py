@@ -5,16 +5,141 @@ import os
 import shutil
 import settings
 import sys
+import time
+import uuid
+import weakref
+from pathlib import Path
 from urllib.parse import quote
 
 # Fix SSL issue with chromium
 os.environ["PYPPETEER_DOWNLOAD_HOST"] = "http://storage.googleapis.com"
 from pyppeteer import launch
+from pyppeteer.errors import TimeoutError as BrowserTimeoutError
+
+try:
+    from nbconvert import HTMLExporter  # Optional, only needed by the offline renderer, requires nbconvert<6
+except ImportError:
+    HTMLExporter = None
 
 
 BASE_HUB_URL = getattr(settings, 'BASE_HUB_URL', "https://notebook.genepattern.org")
 SCREENSHOT_USER = getattr(settings, 'SCREENSHOT_USER', "xxx")
 SCREENSHOT_PASSWORD = getattr(settings, 'SCREENSHOT_PASSWORD', "xxx")
+READY_TIMEOUT = getattr(settings, 'SCREENSHOT_READY_TIMEOUT', 90)
+
+# Renderers: 'hub' opens the notebook in the screenshot user's server, 'offline' converts it to static HTML locally
+HUB = 'hub'
+OFFLINE = 'offline'
+
+# Directory of the nbconvert template used by the offline renderer
+PREVIEW_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preview')
+
+# The pages that can follow a login: the hub's start button or spawn form, the spawn progress page, or the notebook
+HUB_STATES = '#start, #spawn_form, #progress-message, #ipython-main-app'
+
+# The notebook has loaded its cells and started its kernel
+NOTEBOOK_LOADED = "() => window.Jupyter !== undefined && Jupyter.notebook !== undefined && Jupyter.notebook._fully_loaded === true"
+
+# Every widget output has rendered its view in place of the loading placeholder
+WIDGETS_RENDERED = """() => Array.from(document.querySelectorAll('.output_subarea')).every(
+    e => e.querySelector('.widget-loading') === null && e.textContent.indexOf('Loading widget...') < 0)"""
+
+# MathJax has finished typesetting, or isn't used by the page
+MATHJAX_DONE = "() => window.MathJax === undefined || MathJax.Hub === undefined || MathJax.Hub.queue.pending === 0"
+
+# Network activity is idle once no requests have been in flight for NETWORK_IDLE_TIME seconds, waiting
+# at most NETWORK_IDLE_LIMIT seconds, since a notebook may keep polling for as long as it is open
+NETWORK_IDLE_TIME = 0.5
+NETWORK_IDLE_LIMIT = 10
+
+
+class ReadinessTimeout(Exception):
+    """
+    Raised when a page doesn't reach a required phase within the time budget
+    """
+
+    def __init__(self, phase, timings):
+        reached = ', '.join('%s %.1fs' % t for t in timings) or 'none'
+        super(ReadinessTimeout, self).__init__('Timed out waiting for ' + phase + ' (phases reached: ' + reached + ')')
+        self.phase = phase
+
+
+class NetworkTracker:
+    """
+    Tracks the requests a page has in flight, so that captures can wait for network idle
+    """
+
+    def __init__(self, page):
+        self.in_flight = set()
+        self.last_change = time.monotonic()
+        page.on('request', self._started)
+        page.on('requestfinished', self._finished)
+        page.on('requestfailed', self._finished)
+
+    def _started(self, request):
+        self.in_flight.add(request)
+        self.last_change = time.monotonic()
+
+    def _finished(self, request):
+        self.in_flight.discard(request)
+        self.last_change = time.monotonic()
+
+    async def wait_for_idle(self, timeout):
+        async def idle():
+            while self.in_flight or time.monotonic() - self.last_change < NETWORK_IDLE_TIME:
+                await asyncio.sleep(0.1)
+        await asyncio.wait_for(idle(), timeout)
+
+
+_network_trackers = weakref.WeakKeyDictionary()
+
+
+def network_tracker(page):
+    if page not in _network_trackers:
+        _network_trackers[page] = NetworkTracker(page)
+    return _network_trackers[page]
+
+
+class Readiness:
+    """
+    Moves a page through the phases of getting ready for a screenshot, each waiting on a
+    concrete signal rather than a fixed sleep, under one overall time budget. Required phases
+    raise ReadinessTimeout when the budget runs out, best-effort phases are recorded in
+    timed_out and the capture goes ahead.
+    """
+
+    def __init__(self, page, budget=READY_TIMEOUT):
+        self.page = page
+        self.deadline = time.monotonic() + budget
+        self.timings = []    # (phase, seconds) of each phase reached
+        self.timed_out = []  # Best-effort phases that ran out of time
+
+    def _remaining(self, limit=None):
+        remaining = self.deadline - time.monotonic()
+        if limit is not None:
+            remaining = min(remaining, limit)
+        return max(remaining, 0.001)  # pyppeteer treats a timeout of 0 as no timeout
+
+    async def _wait(self, phase, waiter, required, limit=None):
+        start = time.monotonic()
+        try:
+            await waiter(self._remaining(limit))
+        except (BrowserTimeoutError, asyncio.TimeoutError):
+            if required:
+                raise ReadinessTimeout(phase, self.timings)
+            self.timed_out.append(phase)
+            return
+        self.timings.append((phase, time.monotonic() - start))
+
+    async def selector(self, phase, selector, required=True):
+        await self._wait(phase, lambda t: self.page.waitForSelector(selector, {'timeout': t * 1000}), required)
+
+    async def function(self, phase, js, required=True):
+        await self._wait(phase, lambda t: self.page.waitForFunction(js, {'timeout': t * 1000}), required)
+
+    async def network_idle(self, phase='network idle', required=False):
+        tracker = network_tracker(self.page)
+        await self._wait(phase, tracker.wait_for_idle, required, limit=NETWORK_IDLE_LIMIT)
 
 
 def patch_pyppeteer():
@@ -36,12 +161,34 @@ def get_path_arg():
         return None
 
 
-async def fetch_screenshot(nb_file_path):
-    # Obtain the necessary paths and URLs
-    nb_dir_path = os.path.dirname(nb_file_path)
+def get_renderer_arg():
+    if len(sys.argv) >= 3:
+        return sys.argv[2]
+    else:
+        return HUB
+
+
+def get_output_arg():
+    if len(sys.argv) >= 4:
+        return sys.argv[3]
+    else:
+        return None
+
+
+def notebook_path(nb_file_path):
+    # Path on the hub to the screenshot user's copy of the notebook
     nb_file_name = nb_file_path.split(os.path.sep)[-1]
-    nb_url = BASE_HUB_URL + '/hub/login/form?next=' + '/user/' + quote(SCREENSHOT_USER) + '/legacy_project/notebooks/' + quote(nb_file_name)
-    screenshot_path = os.path.join(nb_dir_path, 'preview.png')
+    return '/user/' + quote(SCREENSHOT_USER) + '/legacy_project/notebooks/' + quote(nb_file_name)
+
+
+def screenshot_path(nb_file_path):
+    return os.path.join(os.path.dirname(nb_file_path), 'preview.png')
+
+
+def prepare_notebook(nb_file_path):
+    """
+    Copy the notebook to the screenshot user's space, returns an error message on failure
+    """
     user_dir_path = os.path.join(settings.BASE_USER_PATH, SCREENSHOT_USER, 'legacy_project')
 
     # Lazily create directory, if necessary
@@ -52,21 +199,38 @@ async def fetch_screenshot(nb_file_path):
     if not os.path.isdir(user_dir_path):
         return 'An error was encountered because the user directory is not a directory'
 
-    # Create the browser and page objects
-    browser = await launch({'args': ['--no-sandbox']})
+    shutil.copy(nb_file_path, user_dir_path)
+    return None
+
+
+async def launch_browser():
+    return await launch({'args': ['--no-sandbox']})
+
+
+async def new_page(browser):
     page = await browser.newPage()
+    network_tracker(page)
     await page.setViewport({'width': 1200, 'height': 1000})
+    return page
 
-    # Copy the notebook to the screenshot user's space
-    shutil.copy(nb_file_path, user_dir_path)
 
+async def login(page, next_path, readiness):
     # Open the page and login to the repository
-    await page.goto(nb_url, {'timeout': 120000})
+    await page.goto(BASE_HUB_URL + '/hub/login/form?next=' + next_path, {'timeout': 120000})
     await page.type('#username_input', SCREENSHOT_USER)
     await page.type('#password_input', SCREENSHOT_PASSWORD)
     await page.click('#login_submit')
-    await page.waitFor(10000)
 
+    # Wait until the hub or the notebook is showing
+    await readiness.selector('login', HUB_STATES)
+
+
+async def open_notebook(page, readiness):
+    """
+    Get from the page reached after logging in to the loaded notebook, starting the screenshot
+    user's server if necessary. Returns an error message on failure, and raises
+    ReadinessTimeout if a phase runs out of time.
+    """
     # Check for errors and spawning page
     start_server = await page.querySelector('#start') is not None
     spawn_form = await page.querySelector('#spawn_form') is not None
@@ -78,25 +242,24 @@ async def fetch_screenshot(nb_file_path):
     # If the server is not started, start it and recheck
     if start_server:
         await page.click('#start')
-        await page.waitFor(5000)
+        await readiness.selector('server start', '#spawn_form, #progress-message, #ipython-main-app')
         spawning = await page.querySelector('#progress-message') is not None
         spawn_form = await page.querySelector('#spawn_form') is not None
 
     # If the server is not started, start it and recheck
     if spawn_form:
         await page.click('input.btn-jupyter[value=Spawn]')
-        await page.waitFor(5000)
+        await readiness.selector('spawn form', '#progress-message, #ipython-main-app')
         spawning = await page.querySelector('#progress-message') is not None
 
-    # If spawning, continue to wait and recheck
+    # If spawning, continue to wait until the notebook opens
     if spawning:
-        await page.waitFor(10000)
-        in_notebook = await page.querySelector('#ipython-main-app') is not None
-        if not in_notebook:
-            return 'An error was encountered spawning the notebook server'
+        await readiness.selector('spawn', '#ipython-main-app')
 
-    # Wait for the widgets to load
-    await page.waitFor(5000)
+    # Wait for the notebook to load, for its requests to settle and for the widgets to render
+    await readiness.function('notebook', NOTEBOOK_LOADED)
+    await readiness.network_idle()
+    await readiness.function('widgets', WIDGETS_RENDERED, required=False)
 
     # Close the webtour, if visible
     showing_webtour = await page.querySelector('#gp-hint-box') is not None
@@ -106,11 +269,15 @@ async def fetch_screenshot(nb_file_path):
     # Check for GP Auth widgets and log in
     has_auth_widget = await page.querySelector('.gp-widget-auth') is not None
 
-    if has_auth_widget:  # Login to the GenePattern server
+    if has_auth_widget:  # Login to the GenePattern server, then wait for the widgets to render again
         await page.evaluate("$('.widget-auto-login-buttons > .btn-primary').click();")
+        await readiness.network_idle('widget login')
+        await readiness.function('widgets after login', WIDGETS_RENDERED, required=False)
+
+    return None
 
-    await page.waitFor(5000)
 
+async def take_screenshot(page, path):
     # Fix the CSS for the screenshot
     await page.evaluate("$('#login_widget').hide();")
     await page.evaluate("$('body').css('overflow', 'auto');")
@@ -118,10 +285,82 @@ async def fetch_screenshot(nb_file_path):
     await page.evaluate("$('.widget-username-label').html('&nbsp;');")
 
     # Take a screenshot
-    await page.screenshot({'path': screenshot_path, 'fullPage': True})
-    await browser.close()
+    await page.screenshot({'path': path, 'fullPage': True})
+
+
+def render_html(nb_file_path):
+    """
+    Convert the notebook to static HTML with the repository's preview template, next to the
+    notebook so that relative resources resolve, and return the path to the HTML file
+    """
+    if HTMLExporter is None:
+        raise RuntimeError('nbconvert is required by the offline preview renderer')
+
+    exporter = HTMLExporter(template_path=[PREVIEW_TEMPLATE_PATH], template_file='genepattern.tpl')
+    body, _ = exporter.from_filename(nb_file_path)
+
+    html_path = os.path.join(os.path.dirname(nb_file_path), '.preview-' + uuid.uuid4().hex[:8] + '.html')
+    with open(html_path, 'w', encoding='utf-8') as html_file:
+        html_file.write(body)
+    return html_path
+
+
+async def capture_offline(page, nb_file_path, readiness, output=None):
+    """
+    Screenshot the notebook rendered to static HTML, no hub, server or kernel is involved
+    """
+    html_path = render_html(nb_file_path)
+    try:
+        await page.goto(Path(os.path.abspath(html_path)).as_uri(), {'timeout': 120000})
+
+        # Wait for the scripts the template loads, the embedded widgets and the math to render
+        await readiness.network_idle()
+        await readiness.function('widgets', WIDGETS_RENDERED, required=False)
+        await readiness.function('mathjax', MATHJAX_DONE, required=False)
+
+        await page.screenshot({'path': output or screenshot_path(nb_file_path), 'fullPage': True})
+    finally:
+        os.remove(html_path)
+
+
+async def fetch_offline_screenshot(nb_file_path, output=None):
+    browser = await launch_browser()
+    try:
+        page = await new_page(browser)
+        await capture_offline(page, nb_file_path, Readiness(page), output)
+    except ReadinessTimeout as e:
+        return str(e)
+    finally:
+        await browser.close()
+
+
+async def fetch_screenshot(nb_file_path, output=None):
+    # Copy the notebook to the screenshot user's space
+    error = prepare_notebook(nb_file_path)
+    if error:
+        return error
+
+    # Create the browser and page objects
+    browser = await launch_browser()
+    try:
+        page = await new_page(browser)
+        readiness = Readiness(page)
+
+        # Login to the repository and open the notebook
+        await login(page, notebook_path(nb_file_path), readiness)
+        error = await open_notebook(page, readiness)
+        if error:
+            return error
+
+        await take_screenshot(page, output or screenshot_path(nb_file_path))
+    except ReadinessTimeout as e:
+        return str(e)
+    finally:
+        await browser.close()
 
 
-patch_pyppeteer()  # Workaround for pyppeteer timeout error
-notebook_file_path = get_path_arg()
-asyncio.get_event_loop().run_until_complete(fetch_screenshot(notebook_file_path))
+if __name__ == '__main__':
+    patch_pyppeteer()  # Workaround for pyppeteer timeout error
+    notebook_file_path = get_path_arg()
+    fetch = fetch_offline_screenshot if get_renderer_arg() == OFFLINE else fetch_screenshot
+    asyncio.get_event_loop().run_until_complete(fetch(notebook_file_path, get_output_arg()))
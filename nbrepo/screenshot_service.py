@@ -0,0 +1,186 @@
+#!/opt/conda/envs/repository/bin/python
+"""
+Long-running screenshot service. Keeps a headless browser logged in to the hub and a pool of
+open pages, and takes the preview screenshots requested over a unix socket, one JSON line per
+request. Run it alongside the web service; generate_preview falls back to running screenshot.py
+when the service is not running.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import settings
+import shutil
+import subprocess
+
+from screenshot import BASE_HUB_URL, HUB, OFFLINE, Readiness, ReadinessTimeout, capture_offline, launch_browser, login, \
+    new_page, notebook_path, open_notebook, patch_pyppeteer, prepare_notebook, screenshot_path, take_screenshot
+
+
+SOCKET_PATH = getattr(settings, 'SCREENSHOT_SOCKET', '/tmp/nbrepo-screenshot.sock')
+WORKERS = getattr(settings, 'SCREENSHOT_WORKERS', 2)
+JOB_TIMEOUT = getattr(settings, 'SCREENSHOT_TIMEOUT', 180)
+
+# Get an instance of a logger
+logger = logging.getLogger('screenshot_service')
+
+
+class BrowserPool:
+    """
+    A warm browser and the idle pages left open by earlier captures. Pages share the browser's
+    session, so the hub renderer logs in once and again only when the session expires. At most
+    `size` captures run at once.
+    """
+
+    def __init__(self, size):
+        self.browser = None
+        self.idle_pages = []
+        self.slots = asyncio.Semaphore(size)
+        self.browser_lock = asyncio.Lock()
+        self.file_locks = {}
+
+    async def _ensure_browser(self):
+        # Launch the browser once, and again if it exits
+        async with self.browser_lock:
+            if self.browser is None:
+                browser = await launch_browser()
+                browser.on('disconnected', lambda: self._on_disconnected(browser))
+                self.browser = browser
+                self.idle_pages = []
+            return self.browser
+
+    def _on_disconnected(self, browser):
+        if self.browser is browser:
+            logger.error('Browser exited, relaunching on the next capture')
+            self.browser = None
+            self.idle_pages = []
+
+    async def _capture_offline(self, page, nb_file_path, output):
+        readiness = Readiness(page)
+        try:
+            await capture_offline(page, nb_file_path, readiness, output)
+        except ReadinessTimeout as e:
+            return str(e)
+
+        if readiness.timed_out:
+            logger.info(nb_file_path + ': captured without waiting for ' + ', '.join(readiness.timed_out))
+        return None
+
+    async def _capture(self, page, nb_file_path, output):
+        error = prepare_notebook(nb_file_path)
+        if error:
+            return error
+
+        try:
+            # Go straight to the notebook, logging in again only if the session has expired
+            readiness = Readiness(page)
+            await page.goto(BASE_HUB_URL + notebook_path(nb_file_path), {'timeout': 120000})
+            if await page.querySelector('#username_input') is not None:
+                await login(page, notebook_path(nb_file_path), readiness)
+
+            error = await open_notebook(page, readiness)
+            if error:
+                return error
+        except ReadinessTimeout as e:
+            return str(e)
+
+        if readiness.timed_out:
+            logger.info(nb_file_path + ': captured without waiting for ' + ', '.join(readiness.timed_out))
+        await take_screenshot(page, output or screenshot_path(nb_file_path))
+        return None
+
+    async def capture(self, nb_file_path, renderer=HUB, output=None):
+        """
+        Take the screenshot of a notebook with the given renderer, saved to output or else to the
+        notebook's preview.png, returns an error message on failure
+        """
+        async with self.slots:
+            browser = await self._ensure_browser()
+            page = self.idle_pages.pop() if self.idle_pages else await new_page(browser)
+            try:
+                if renderer == OFFLINE:
+                    error = await asyncio.wait_for(self._capture_offline(page, nb_file_path, output), JOB_TIMEOUT)
+
+                # Notebooks are copied to the screenshot user's space by file name, so two notebooks
+                # with the same name can't be captured at the same time
+                else:
+                    file_lock = self.file_locks.setdefault(os.path.basename(nb_file_path), asyncio.Lock())
+                    async with file_lock:
+                        error = await asyncio.wait_for(self._capture(page, nb_file_path, output), JOB_TIMEOUT)
+            except Exception:
+                # Don't reuse a page left in an unknown state
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+                raise
+
+            if self.browser is browser:
+                self.idle_pages.append(page)
+            return error
+
+    async def close(self):
+        if self.browser is not None:
+            await self.browser.close()
+
+
+async def handle_client(pool, reader, writer):
+    nb_file_path = None
+    try:
+        request = json.loads((await reader.readline()).decode('utf-8'))
+        nb_file_path = request['path']
+        try:
+            error = await pool.capture(nb_file_path, request.get('renderer', HUB), request.get('output'))
+        except asyncio.TimeoutError:
+            error = 'Timed out taking the screenshot'
+        except Exception as e:
+            error = 'An error was encountered taking the screenshot: ' + str(e)
+    except (ValueError, KeyError, TypeError):
+        error = 'Invalid screenshot request'
+
+    if error:
+        logger.error(str(nb_file_path) + ': ' + error)
+
+    try:
+        writer.write(json.dumps({'path': nb_file_path, 'error': error}).encode('utf-8') + b'\n')
+        await writer.drain()
+    except ConnectionError:
+        pass  # The client gave up waiting
+    finally:
+        writer.close()
+
+
+def lower_priority():
+    # Run at a low CPU and IO priority, which the browser inherits, so captures don't slow down the web workers
+    os.nice(getattr(settings, 'SCREENSHOT_NICENESS', 10))
+    if shutil.which('ionice'):
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    patch_pyppeteer()  # Workaround for pyppeteer timeout error
+    lower_priority()
+
+    # Remove the socket left behind by a previous run
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+
+    loop = asyncio.get_event_loop()
+    pool = BrowserPool(WORKERS)
+    server = loop.run_until_complete(asyncio.start_unix_server(lambda r, w: handle_client(pool, r, w), path=SOCKET_PATH))
+    os.chmod(SOCKET_PATH, 0o660)
+    logger.info('Taking screenshots on ' + SOCKET_PATH + ' with ' + str(WORKERS) + ' workers')
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(pool.close())
+
+
+if __name__ == '__main__':
+    main()
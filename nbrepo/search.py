@@ -0,0 +1,124 @@
+import logging
+import re
+
+from django.db import connection, OperationalError
+from django.db.models import Q
+
+from nbrepo.models import Notebook
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# Name of the full-text index table and the relative weights of its columns when ranking
+FTS_TABLE = 'nbrepo_notebook_fts'
+FTS_WEIGHTS = (10.0, 2.0, 5.0, 5.0)  # name, description, author, tags
+
+# Cached result of the lazy index setup, None until the first call
+_fts_ready = None
+
+
+def _fts_available():
+    """
+    Lazily create the SQLite FTS5 index, populating it from the catalog if it is new.
+    Returns False if the database does not support FTS5, in which case search falls
+    back to a simple substring match.
+    """
+    global _fts_ready
+    if _fts_ready is not None:
+        return _fts_ready
+
+    if connection.vendor != 'sqlite':
+        _fts_ready = False
+        return _fts_ready
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=%s", [FTS_TABLE])
+            exists = cursor.fetchone() is not None
+            if not exists:
+                cursor.execute("CREATE VIRTUAL TABLE " + FTS_TABLE + " USING fts5(" +
+                               "name, description, author, tags, tokenize='porter unicode61')")
+        _fts_ready = True
+        if not exists:
+            rebuild_index()
+    except OperationalError as e:
+        logger.error("Full-text search unavailable, falling back to substring match: " + str(e))
+        _fts_ready = False
+
+    return _fts_ready
+
+
+def _tag_text(notebook):
+    return ' '.join(tag.label for tag in notebook.tags.all())
+
+
+def index_notebook(notebook):
+    """
+    Add or replace the index entry for the given notebook
+    """
+    if not _fts_available():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM " + FTS_TABLE + " WHERE rowid = %s", [notebook.id])
+        cursor.execute("INSERT INTO " + FTS_TABLE + " (rowid, name, description, author, tags) VALUES (%s, %s, %s, %s, %s)",
+                       [notebook.id, notebook.name, notebook.description, notebook.author, _tag_text(notebook)])
+
+
+def unindex_notebook(notebook_id):
+    """
+    Remove the index entry for the notebook with the given id
+    """
+    if not _fts_available():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM " + FTS_TABLE + " WHERE rowid = %s", [notebook_id])
+
+
+def rebuild_index():
+    """
+    Drop every index entry and reindex the whole catalog
+    """
+    if not _fts_available():
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM " + FTS_TABLE)
+        for notebook in Notebook.objects.all().prefetch_related('tags'):
+            cursor.execute("INSERT INTO " + FTS_TABLE + " (rowid, name, description, author, tags) VALUES (%s, %s, %s, %s, %s)",
+                           [notebook.id, notebook.name, notebook.description, notebook.author, _tag_text(notebook)])
+
+
+def _match_expression(terms):
+    # Quote each term so user input cannot inject FTS operators, and prefix match the terms
+    return ' '.join('"' + term.replace('"', '') + '"*' for term in terms)
+
+
+def search(query, limit=50):
+    """
+    Return up to limit notebooks matching every term of the query, best matches first
+    """
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return []
+
+    # Fall back to a case-insensitive substring match if there is no full-text index
+    if not _fts_available():
+        matches = Notebook.objects.all()
+        for term in terms:
+            matches = matches.filter(Q(name__icontains=term) | Q(description__icontains=term) |
+                                     Q(author__icontains=term) | Q(tags__label__icontains=term))
+        return list(matches.distinct().order_by('weight', 'id').prefetch_related('tags')[:limit])
+
+    # Rank the matches using the weighted BM25 score of each column
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT rowid FROM " + FTS_TABLE + " WHERE " + FTS_TABLE + " MATCH %s " +
+                       "ORDER BY bm25(" + FTS_TABLE + ", %s, %s, %s, %s) LIMIT %s",
+                       [_match_expression(terms)] + list(FTS_WEIGHTS) + [limit])
+        ids = [row[0] for row in cursor.fetchall()]
+
+    # Load the notebooks in one query and return them in ranked order
+    notebooks = {nb.id: nb for nb in Notebook.objects.filter(id__in=ids).prefetch_related('tags')}
+    return [notebooks[i] for i in ids if i in notebooks]
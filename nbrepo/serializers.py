@@ -1,6 +1,6 @@
 from django.contrib.auth.models import User, Group
 from rest_framework import serializers
-from nbrepo.models import Notebook, Tag, Webtour, Comment
+from nbrepo.models import Notebook, Tag, Webtour, Comment, PublishJob
 from .sharing import CollaboratorSerializer, SharingSerializer
 
 
@@ -42,6 +42,12 @@ class NotebookSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('id', 'url', 'name', 'description', 'author', 'quality', 'publication', 'owner', 'file_path', 'api_path', 'weight', 'tags')
 
 
+class PublishJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PublishJob
+        fields = ('id', 'notebook', 'action', 'status', 'step', 'error', 'created', 'updated')
+
+
 class AuthTokenSerializer(serializers.Serializer):
 
     def update(self, instance, validated_data):
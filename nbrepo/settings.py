@@ -80,6 +80,16 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.10/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 
@@ -167,15 +177,42 @@ BASE_GENEPATTERN_URL = 'https://cloud.genepattern.org/gp'
 BASE_REPO_PATH = './data/repository/'
 BASE_USER_PATH = './data/users/'
 BASE_SHARE_PATH = './data/shared/'
+BLOB_STORE_PATH = './data/blobs/'
+REVISION_STORE_PATH = './data/revisions/'
 CAN_SET_PROTECTED_TAGS = ['beholdsa', 'tabor', 'admin']
 JUPYTERHUB = True
 BASE_HUB_URL = "https://notebook.genepattern.org"
 SCREENSHOT_USER = "xxx"
 SCREENSHOT_PASSWORD = "xxx"
+SCREENSHOT_SOCKET = "/tmp/nbrepo-screenshot.sock"
+SCREENSHOT_WORKERS = 2
+SCREENSHOT_TIMEOUT = 180
+SCREENSHOT_READY_TIMEOUT = 90
+SCREENSHOT_NICENESS = 10
+PREVIEW_QUEUE_PATH = './data/previews/'
+PREVIEW_CONCURRENCY = 2
+PREVIEW_RETRY_AFTER = 5
+PREVIEW_MAX_FAILURES = 3  # Failed captures of the same content before giving up, until it changes
+PREVIEW_FAILURE_BACKOFF = 60  # Seconds before retrying a failed capture, doubled after each failure
+PREVIEW_STYLE_VERSION = ''  # Change after a theme or CSS change, then run ./manage.py rerender_previews
+PREVIEW_RENDERER = "hub"  # Or "offline", to render notebooks with nbconvert instead of the screenshot user's server
 DEFAULT_NB_DIR = './data/defaults/'
 AUTOSCALE_SCRIPT = None
+CATALOG_CACHE_TIMEOUT = 86400
+COUNTER_JOURNAL_PATH = './data/counters/'
+COUNTER_FLUSH_INTERVAL = 30
+PUBLISH_WORKERS = 2
+PUBLISH_JOB_TIMEOUT = 600
+PUBLISH_REQUEUE_INTERVAL = 60  # Seconds between checks for jobs left behind by a worker that exited
+PRESENCE_PATH = None  # Defaults to a directory in /dev/shm
+PRESENCE_TTL = 60
+PRESENCE_PERSIST_INTERVAL = 600
+PRESENCE_MAX_WAIT = 5  # Seconds a request for the list of editors may wait for it to change
 
 NOTIFICATION_EMAIL = None
 EMAIL_SERVER = 'smtp-server'
 EMAIL_USERNAME = 'username'
-EMAIL_PASSWORD = 'password'
\ No newline at end of file
+EMAIL_PASSWORD = 'password'
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_DELAY = 30
\ No newline at end of file
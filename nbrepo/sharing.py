@@ -1,24 +1,24 @@
 import hashlib
 import json
+import logging
 import os
 import random
 import re
-import smtplib
-import time
 import urllib
 import urllib.parse
 from datetime import datetime
 
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from pathlib import Path
 from shutil import copyfile
 
 from django.conf import settings
 from django.conf.urls import url
 from django.contrib.auth.models import User
+from django.http import Http404
 from django.shortcuts import redirect, render, get_object_or_404
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 
 from rest_framework import permissions
 from rest_framework import serializers
@@ -26,6 +26,22 @@ from rest_framework import viewsets
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 
+from . import presence
+from .outbox import queue_email
+from .pagination import IdCursorPagination
+from .revisions import ShareRevision, matches_revision, record_revision, write_revision
+
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+# Prefix of share_with entries naming a roster rather than a single user
+GROUP_PREFIX = 'group:'
+
+# Limits on the notebook paths looked up by current_collaborators_batch, per request and per query
+BATCH_MAX_PATHS = 1000
+BATCH_CHUNK_SIZE = 100
+
 
 ##################
 # From models.py #
@@ -38,11 +54,27 @@ class Share(models.Model):
 
     # The file path to the published copy of the notebook, relative to settings.BASE_SHARE_PATH
     # Will usually be: [settings.BASE_SHARE_PATH/] owner_username/owner_file_path
-    api_path = models.CharField(max_length=256)
+    api_path = models.CharField(max_length=256, unique=True)
+
+    # The api_path split into the owner's username and the path relative to the owner's directory, for indexed lookups
+    owner_username = models.CharField(max_length=128, default='')
+    path = models.CharField(max_length=256, default='')
+
+    # SHA-256 of the shared copy and a counter incremented each time its content changes
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    version = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = (('owner_username', 'path'),)
 
     def __str__(self):
         return self.api_path
 
+    def save(self, *args, **kwargs):
+        # Keep the owner and path columns in sync with api_path
+        self.owner_username, _, self.path = self.api_path.partition('/')
+        super(Share, self).save(*args, **kwargs)
+
     def owner(self):
         """
         Returns the Collaborator instance for the owner of the shared notebook.
@@ -55,18 +87,51 @@ class Share(models.Model):
         return None
 
 
+class Roster(models.Model):
+    name = models.CharField(max_length=64, unique=True)  # Shared with as group:<name>
+    owner = models.CharField(max_length=64)              # Username of the user who manages the roster
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+
+class RosterMember(models.Model):
+    roster = models.ForeignKey(Roster, on_delete=models.CASCADE, related_name='members')
+    user = models.CharField(max_length=64, db_index=True)  # Username or email of the member
+
+    class Meta:
+        unique_together = ('roster', 'user')
+
+    def __str__(self):
+        return str(self.roster) + ' (' + self.user + ')'
+
+
 class Collaborator(models.Model):
     share = models.ForeignKey(Share, on_delete=models.CASCADE, related_name='shared_with')
     user = models.CharField(max_length=64)
     owner = models.BooleanField(default=False)
 
+    # Set on the group:<name> entry of a share made with a roster and on the rows of its members,
+    # which are created the first time each member accesses the share, and cleared once a member is also shared with directly
+    roster = models.ForeignKey(Roster, on_delete=models.CASCADE, null=True, blank=True, related_name='collaborators')
+    declined = models.BooleanField(default=False)  # Set when a roster member declines, instead of deleting the row
+
     email = models.CharField(max_length=128)
-    token = models.CharField(max_length=128)
+    token = models.CharField(max_length=128, db_index=True)
     accepted = models.BooleanField(default=False)
     last_accessed = models.DateTimeField(null=True)
 
     # The file path for the linked file for this particular user, relative to the user's directory
-    file_path = models.CharField(max_length=256, null=True)
+    file_path = models.CharField(max_length=256, null=True, db_index=True)
+
+    # The share version and content hash this user's file matched when it was last synced
+    synced_version = models.IntegerField(default=0)
+    synced_hash = models.CharField(max_length=64, blank=True, default='')
+
+    class Meta:
+        # Lookups of a user's row on a share, and of a user's shares or a user's file, which also cover lookups by user alone
+        index_together = (('share', 'user'), ('user', 'file_path'))
 
     def __str__(self):
         return str(self.share) + ' (' + self.email + ')'
@@ -98,8 +163,9 @@ class SharingViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows notebooks to be viewed or edited.
     """
-    queryset = Share.objects.all()
+    queryset = Share.objects.all().prefetch_related('shared_with')
     serializer_class = SharingSerializer
+    pagination_class = IdCursorPagination
     filter_fields = ('name', 'api_path', )
     permission_classes = (permissions.AllowAny, )
 
@@ -110,6 +176,7 @@ class CollaboratorViewSet(viewsets.ModelViewSet):
     """
     queryset = Collaborator.objects.all()
     serializer_class = CollaboratorSerializer
+    pagination_class = IdCursorPagination
     filter_fields = ('user', 'owner', 'token', 'accepted', 'file_path', )
     permission_classes = (permissions.AllowAny, )
 
@@ -129,7 +196,7 @@ def _create_new_share(owner, api_path, file_path):
     notebook = Share()
     notebook.name = api_path.split('/')[-1]
     notebook.api_path = api_path
-    notebook.last_updated = datetime.now()
+    notebook.last_updated = timezone.now()
     notebook.save()
 
     # Add the owner as a collaborator
@@ -144,39 +211,54 @@ def _create_new_share(owner, api_path, file_path):
     return notebook
 
 
-def _sync_collaborators(notebook, users):
-    # Get the list of collaborators for the notebook
-    collaborators = Collaborator.objects.filter(share=notebook)
-    existing = []
-    for c in collaborators:
-        if c.user:
-            existing.append(c.user)
-        if c.email:
-            existing.append(c.email)
-
-    # Figure out which need added
-    need_added = []
-    for user in users:
-        if user not in existing:
-            need_added.append(user)
-
-    # Figure out which need removed
-    need_removed = []
-    for user in collaborators:
-        if user.email not in users and user.user not in users and not user.owner:
-            need_removed.append(user)
-
-    # Remove collaborators as necessary
-    for user in need_removed:
-        user.delete()
-
-    # Add collaborators as necessary
-    user_errors = []
-    for user in need_added:
-        try:
-            _create_collaborator(notebook, user)
-        except Exception as e:
-            user_errors.append(user)
+def _still_shared(c, requested_set):
+    # Members of a roster keep their row for as long as the share is still made with the roster
+    return c.owner or c.email in requested_set or c.user in requested_set or \
+        (c.roster is not None and GROUP_PREFIX + c.roster.name in requested_set)
+
+
+def _sync_collaborators(notebook, users, sharer):
+    # The requested users, emails and groups, without duplicates but in the order given
+    requested = list(dict.fromkeys(users))
+    requested_set = set(requested)
+
+    with transaction.atomic():
+        # Get the list of collaborators for the notebook in one query
+        collaborators = list(Collaborator.objects.filter(share=notebook).select_related('roster'))
+        owner_model = next((c for c in collaborators if c.owner), None)
+        existing = {c.user for c in collaborators if c.user} | {c.email for c in collaborators if c.email}
+
+        # Figure out which need added and which need removed
+        need_added = [user for user in requested if user not in existing]
+        need_removed = [c.id for c in collaborators if not _still_shared(c, requested_set)]
+
+        # Remove collaborators in a single delete
+        if need_removed:
+            Collaborator.objects.filter(id__in=need_removed).delete()
+
+        # Roster members now also shared with directly keep their access if they leave the roster
+        now_direct = [c.id for c in collaborators if c.roster_id and not c.user.startswith(GROUP_PREFIX)
+                      and (c.user in requested_set or c.email in requested_set)]
+        if now_direct:
+            Collaborator.objects.filter(id__in=now_direct).update(roster=None)
+
+        # Build the new collaborators, collecting any that are invalid
+        user_errors = []
+        new_collaborators = []
+        for user in need_added:
+            try:
+                new_collaborators.append(_new_collaborator(notebook, user, sharer))
+            except ValueError:
+                user_errors.append(user)
+
+        # Add the collaborators in a single insert, then read them back by token to get their ids
+        if new_collaborators:
+            Collaborator.objects.bulk_create(new_collaborators)
+            created = list(Collaborator.objects.filter(share=notebook, token__in=[c.token for c in new_collaborators]))
+
+            # Queue the invitations once the changes are committed, groups get none since their
+            # members are only resolved when they access the share
+            transaction.on_commit(lambda: _send_invitations(notebook, owner_model, created))
 
     return user_errors
 
@@ -213,19 +295,25 @@ def begin_sharing(request):
     except Share.DoesNotExist:
         notebook = _create_new_share(owner, api_path, nb_path)
 
-    # Update the shared notebook on the file system
+    # Update the shared notebook on the file system, unless its content is unchanged
     try:
         local_path = os.path.join(settings.BASE_USER_PATH, request.user.username, named_server, nb_path)
         share_path = os.path.join(settings.BASE_SHARE_PATH, api_path)
 
         os.makedirs(os.path.dirname(share_path), exist_ok=True)  # Lazily create the directory, if necessary
-        copyfile(local_path, share_path)
+        local_hash = _file_hash(local_path)
+        if local_hash != notebook.content_hash or not os.path.exists(share_path):
+            _update_share_file(notebook, local_path, local_hash, request.user.username)
+
+        # The sharing user's copy is now in sync with the shared copy
+        Collaborator.objects.filter(share=notebook, user=request.user.username) \
+            .update(synced_hash=local_hash, synced_version=notebook.version)
     except Exception as e:
         return_obj = {"error": "Unable to copy shared notebook. " + str(e)}
         return Response(return_obj, status=400)
 
     # Sync the collaborators in the request with the collaborators in the database
-    user_errors = _sync_collaborators(notebook, users)
+    user_errors = _sync_collaborators(notebook, users, request.user)
 
     # If any users get an error message, return an error
     if len(user_errors) > 0:
@@ -243,11 +331,8 @@ def remove_sharing(request, pk):
     # Look up the sharing entry
     nb = get_object_or_404(Share, id=pk)
 
-    # Get the current username
-    username = request.user.username
-
     # Get the current collaborator
-    collaborator = get_object_or_404(Collaborator, user=username, share=nb)
+    collaborator = _get_collaborator(nb, request.user)
 
     # Ensure the current user has owner permissions
     if not collaborator.owner:
@@ -298,12 +383,13 @@ def accept_sharing(request, pk):
 
     # Otherwise, get the current collaborator by username
     else:
-        collaborator = get_object_or_404(Collaborator, user=username, share=nb)
+        collaborator = _get_collaborator(nb, request.user)
 
     # If this fails, get the current collaborator by id
 
     # Mark sharing as accepted
     collaborator.accepted = True
+    collaborator.declined = False
     collaborator.save()
 
     # If this was a GET request, redirect to the Public Notebooks tab
@@ -320,14 +406,15 @@ def decline_sharing(request, pk):
     # Look up the sharing entry
     nb = get_object_or_404(Share, id=pk)
 
-    # Get the current username
-    username = request.user.username
-
     # Get the current collaborator
-    collaborator = get_object_or_404(Collaborator, user=username, share=nb)
+    collaborator = _get_collaborator(nb, request.user)
 
-    # Remove the collaborator from the shared notebook
-    collaborator.delete()
+    # Remove the collaborator from the shared notebook, roster members are only marked as
+    # declined so that the share is not resolved for them again on their next access
+    if collaborator.roster_id and not collaborator.user.startswith(GROUP_PREFIX):
+        Collaborator.objects.filter(id=collaborator.id).update(declined=True, accepted=False)
+    else:
+        collaborator.delete()
 
     # Otherwise, return a 200 response in the API
     return Response(nb.name + " sharing declines.", status=200)
@@ -364,36 +451,29 @@ def _generate_token():
 
 
 def _send_email(from_email, to_email, subject, message):
-    tries = [0]
+    # Queue the email in the outbox, it is delivered and retried in the background
+    queue_email(from_email, to_email, subject, message)
 
-    def attempt_sending():
-        tries[0] += 1
 
-        try:
-            msg = MIMEMultipart()
-            msg['From'] = from_email
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            msg.attach(MIMEText(message, 'html'))
-
-            server = smtplib.SMTP(settings.EMAIL_SERVER, 25)
-            if hasattr(settings, 'EMAIL_USERNAME'):
-                server.login(settings.EMAIL_USERNAME, settings.EMAIL_PASSWORD)
-            text = msg.as_string()
-            server.sendmail(from_email, to_email.split(', '), text)
-            server.quit()
-        except:
-            if tries[0] < 2:
-                time.sleep(3)
-                attempt_sending()
-
-    attempt_sending()
-
-
-def _create_collaborator(nb, name_or_email):
+def _new_collaborator(nb, name_or_email, sharer):
     name = ''
     email = ''
 
+    # Reject blank entries
+    if not name_or_email.strip():
+        raise ValueError("Blank user")
+
+    # Share with a roster as a single entry, its members are resolved when they access the share.
+    # Only the roster's owner and members may share with it.
+    if name_or_email.startswith(GROUP_PREFIX):
+        try:
+            roster = Roster.objects.get(name=name_or_email[len(GROUP_PREFIX):])
+        except Roster.DoesNotExist:
+            raise ValueError("Unknown group")
+        if not _in_roster(roster, sharer):
+            raise ValueError("Not a member of the group")
+        return Collaborator(share=nb, user=name_or_email, roster=roster, token=_generate_token())
+
     # Guess if provided with name or email
     is_email = _is_email(name_or_email)
     if is_email:
@@ -408,17 +488,13 @@ def _create_collaborator(nb, name_or_email):
     #         u = User.objects.get(username=name.lower())
     #         email = '' if u.email is None else u.email
     #     except User.DoesNotExist:
-    #         raise Exception("Unknown user")
+    #         raise ValueError("Unknown user")
 
     # If email, make the username match the email for now
     if is_email:
         name = email
 
-    # Get the owner's username or email
-    owner_model = nb.owner()
-    owner = owner_model.user if owner_model.user else owner_model.email
-
-    # Otherwise, create the collaborator
+    # Otherwise, create the collaborator, it is saved by the caller
     c = Collaborator()
     c.share = nb
     c.user = name
@@ -426,53 +502,210 @@ def _create_collaborator(nb, name_or_email):
     c.email = email
     c.token = _generate_token()
     c.accepted = False
-    c.save()
+    return c
+
+
+def _identities(user):
+    # The names a user can be listed by in a roster, their username and their email
+    return {user.username, getattr(user, 'email', '')} - {''}
+
+
+def _in_roster(roster, user):
+    return roster.owner == user.username or roster.members.filter(user__in=_identities(user)).exists()
+
+
+def _expand_groups(user, nb=None):
+    """
+    Give the user their own collaborator row on each share made with a roster they belong to, by
+    username or by email, and have not accessed yet, optionally only for the given share. Returns
+    the number of rows created.
+    """
+    username = user.username
+    email = getattr(user, 'email', '') or (username if _is_email(username) else '')
+    groups = Collaborator.objects.filter(roster__members__user__in=_identities(user), user__startswith=GROUP_PREFIX) \
+        .exclude(share__shared_with__user=username)
+    if nb is not None:
+        groups = groups.filter(share=nb)
+
+    # One row per share, even if the share is made with more than one of the user's rosters
+    new_collaborators = {}
+    for g in groups:
+        if g.share_id not in new_collaborators:
+            new_collaborators[g.share_id] = Collaborator(share_id=g.share_id, user=username, roster_id=g.roster_id,
+                                                         email=email, token=_generate_token())
+
+    if new_collaborators:
+        Collaborator.objects.bulk_create(new_collaborators.values())
+    return len(new_collaborators)
+
+
+def _get_collaborator(nb, user):
+    # Get the user's collaborator row, resolving roster membership the first time a member accesses the share
+    collaborator = Collaborator.objects.filter(user=user.username, share=nb).first()
+    if collaborator is None and _expand_groups(user, nb):
+        collaborator = Collaborator.objects.filter(user=user.username, share=nb).first()
+    if collaborator is None:
+        raise Http404
+    return collaborator
+
+
+def _send_invitations(nb, owner_model, collaborators):
+    # Get the owner's username or email
+    owner = (owner_model.user if owner_model.user else owner_model.email) if owner_model else ''
+    domain = 'https://notebook.genepattern.org' if settings.JUPYTERHUB else 'http://localhost'
 
     # If email or user has known email, send an email to the user
-    if email:
-        domain = 'https://notebook.genepattern.org' if settings.JUPYTERHUB else 'http://localhost'
+    for c in collaborators:
+        if c.email:
+            _send_email("gp-info@broadinstitute.org", c.email, "Notebook Sharing Invite - GenePattern Notebook Repository", """
+            <p>%s has invited you to share the following notebook on the GenePattern Notebook Repository: %s. To accept, just sign in and then click the link below.</p>
+
+            <h5>GenePattern Notebook Repository</h5>
+            <p><a href="https://notebook.genepattern.org">https://notebook.genepattern.org</a></p>
+
+            <h5>Click below to accept shared notebook</h5>
+            <p><a href="%s/services/sharing/sharing/%s/accept/?collaborator=%s">%s/services/sharing/sharing/%s/accept/?collaborator=%s</a></p>
+            """ % (owner, nb.name, domain, nb.id, c.id, domain, nb.id, c.id))
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _update_share_file(nb, local_path, local_hash, author):
+    # Copy the local file over the shared copy and record it as a new version
+    copyfile(local_path, os.path.join(settings.BASE_SHARE_PATH, nb.api_path))
+    _new_share_version(nb, local_hash, author)
+
+
+def _new_share_version(nb, content_hash, author):
+    # Bump the version of the shared copy and add it to the revision history
+    Share.objects.filter(id=nb.id).update(content_hash=content_hash, version=F('version') + 1, last_updated=timezone.now())
+    nb.refresh_from_db(fields=['content_hash', 'version', 'last_updated'])
+    try:
+        record_revision(nb, os.path.join(settings.BASE_SHARE_PATH, nb.api_path), author)
+    except Exception as e:
+        # A missing revision should never block syncing the notebook itself
+        logger.error("Unable to record revision of " + nb.api_path + ": " + str(e))
+
 
-        _send_email("gp-info@broadinstitute.org", email, "Notebook Sharing Invite - GenePattern Notebook Repository", """
-        <p>%s has invited you to share the following notebook on the GenePattern Notebook Repository: %s. To accept, just sign in and then click the link below.</p>
+def _mark_synced(collaborator, nb, content_hash):
+    # Record the version and content this collaborator's file now matches
+    if collaborator.synced_version != nb.version or collaborator.synced_hash != content_hash:
+        collaborator.synced_version = nb.version
+        collaborator.synced_hash = content_hash
+        Collaborator.objects.filter(id=collaborator.id).update(synced_version=nb.version, synced_hash=content_hash)
 
-        <h5>GenePattern Notebook Repository</h5>
-        <p><a href="https://notebook.genepattern.org">https://notebook.genepattern.org</a></p>
 
-        <h5>Click below to accept shared notebook</h5>
-        <p><a href="%s/services/sharing/sharing/%s/accept/?collaborator=%s">%s/services/sharing/sharing/%s/accept/?collaborator=%s</a></p>
-        """ % (owner, nb.name, domain, c.share.id, c.id, domain, c.share.id, c.id))
+def _copy_to_local(nb, share_path, local_path, collaborator):
+    # Copy the shared copy over the local file and record the hash of the content actually copied
+    copyfile(share_path, local_path)
+    copied_hash = _file_hash(local_path)
+
+    # Shares made before content hashes were recorded get theirs now, so the next sync compares hashes
+    if not nb.content_hash:
+        nb.content_hash = copied_hash
+        Share.objects.filter(id=nb.id, content_hash='').update(content_hash=copied_hash)
+
+    _mark_synced(collaborator, nb, copied_hash)
+
+
+def _versioned(response, nb):
+    # Tell the client which version of the shared notebook it now has
+    response['X-Share-Version'] = str(nb.version)
+    return response
+
+
+def _collaborator_name(c):
+    if c.user:
+        return c.user
+    elif c.email:
+        return c.email
+    return None
 
 
 @api_view(['GET'])
 @permission_classes((permissions.AllowAny,))
 def current_collaborators(request, api_path):
+    # Split the path into the owner and the path relative to the owner's directory, which may contain folders
     decoded_path = urllib.parse.unquote(api_path)
-    user = decoded_path.split('/', 2)[0]
-    nb_path = decoded_path.split('/', 2)[1]
-    matches = Collaborator.objects.filter(share__api_path__startswith=user, share__api_path__endswith=nb_path)
+    owner, _, nb_path = decoded_path.partition('/')
+    matches = Collaborator.objects.filter(share__owner_username=owner, share__path=nb_path)
 
     return_list = []
     for c in matches:
-        if c.user and c.email:
-            return_list.append(c.user)
-        elif c.user:
-            return_list.append(c.user)
-        elif c.email:
-            return_list.append(c.email)
+        name = _collaborator_name(c)
+        if name:
+            return_list.append(name)
 
     return_obj = {"shared_with": return_list}
     return Response(json.dumps(return_obj))
 
 
+@api_view(['POST'])
+@permission_classes((permissions.AllowAny,))
+def current_collaborators_batch(request):
+    # The list of paths to look up, each in the same format as for current_collaborators
+    paths = request.data['paths'] if 'paths' in request.data else []
+    if not isinstance(paths, list) or not paths:
+        return_obj = {"error": "A list of paths is required."}
+        return Response(return_obj, status=400)
+    if len(paths) > BATCH_MAX_PATHS:
+        return_obj = {"error": "At most " + str(BATCH_MAX_PATHS) + " paths can be looked up at once."}
+        return Response(return_obj, status=400)
+
+    # Look up the collaborators of the paths a chunk at a time, each path adds a term to the
+    # query and SQLite limits the depth of an expression
+    shared_with = {path: [] for path in paths}
+    by_api_path = {urllib.parse.unquote(path): path for path in paths}
+    api_paths = list(by_api_path)
+    for start in range(0, len(api_paths), BATCH_CHUNK_SIZE):
+        query = Q()
+        for api_path in api_paths[start:start + BATCH_CHUNK_SIZE]:
+            owner, _, nb_path = api_path.partition('/')
+            query |= Q(share__owner_username=owner, share__path=nb_path)
+
+        # Group the collaborators by the requested path
+        for c in Collaborator.objects.filter(query).select_related('share'):
+            name = _collaborator_name(c)
+            path = by_api_path.get(c.share.owner_username + '/' + c.share.path)
+            if name and path is not None:
+                shared_with[path].append(name)
+
+    return Response({"shared_with": shared_with})
+
+
 @api_view(['GET'])
 @permission_classes((permissions.AllowAny,))
 def shared_with_me(request):
-    if request.user:
+    if request.user.username:
         username = request.user.username
-        c_list = Collaborator.objects.filter(user=username)
+
+        # Load the user's collaborations, their shares and every collaborator of those shares in a fixed number of
+        # queries. Shares made with the user's rosters are listed by their group entry until the user first accesses
+        # them, which gives the user their own row, so listing them doesn't write anything.
+        own_shares = Collaborator.objects.filter(user=username).values('share_id')
+        roster_shares = Q(user__startswith=GROUP_PREFIX, roster__members__user__in=_identities(request.user)) & \
+            ~Q(share_id__in=own_shares)
+        c_list = Collaborator.objects.filter(Q(user=username, declined=False) | roster_shares).distinct() \
+            .select_related('share').prefetch_related('share__shared_with')
+
+        # Return one page at a time
+        paginator = IdCursorPagination()
+        page = paginator.paginate_queryset(c_list, request)
 
         notebook_list = []
-        for c in c_list:
+        listed = set()
+        for c in page:
+            # A share made with more than one of the user's rosters is listed once
+            if c.share_id in listed:
+                continue
+            listed.add(c.share_id)
+
             nb = {}
             nb['name'] = c.share.name
             nb['id'] = c.share.id
@@ -492,7 +725,7 @@ def shared_with_me(request):
             nb['collaborators'] = collaborator_list
 
             notebook_list.append(nb)
-        return Response(json.dumps(notebook_list))
+        return paginator.get_paginated_response(notebook_list)
 
     else:
         return_obj = {"error": "Must be logged in to have notebooks shared with you."}
@@ -509,7 +742,7 @@ def copy_share(request, pk, local_dir_path):
     username = request.user.username
 
     # Get the current collaborator
-    collaborator = get_object_or_404(Collaborator, user=username, share=nb)
+    collaborator = _get_collaborator(nb, request.user)
 
     # If named servers are enabled, get the server name
     named_server = _extract_server_name(request)
@@ -521,30 +754,47 @@ def copy_share(request, pk, local_dir_path):
 
     # Either way, get the local path
     local_path = Path(os.path.join(settings.BASE_USER_PATH, request.user.username, named_server, collaborator.file_path)) if settings.JUPYTERHUB else Path(os.path.join(settings.BASE_USER_PATH, named_server, collaborator.file_path))
+    share_path = os.path.join(settings.BASE_SHARE_PATH, nb.api_path)
 
     # Check to see if the notebook exists, if not copy the shared notebook there and return
     if not local_path.exists():
-        copyfile(os.path.join(settings.BASE_SHARE_PATH, nb.api_path), str(local_path))
+        _copy_to_local(nb, share_path, str(local_path), collaborator)
         local_path.chmod(0o777)
-        return Response('Shared notebook lazily created', status=200)
+        return _versioned(Response('Shared notebook lazily created', status=200), nb)
 
-    # If it does, get the last updated timestamp of the file
-    local_last_updated = local_path.stat().st_mtime
+    # If the content is identical, there is nothing to copy
+    local_hash = _file_hash(str(local_path))
+    if local_hash == nb.content_hash:
+        _mark_synced(collaborator, nb, local_hash)
 
-    # Compare last_updated of the file vs. the db entry, if the db entry is newer, overwrite the local file and return
-    # Local file older than the repo file
-    if local_last_updated < nb.last_updated.timestamp():
-        copyfile(os.path.join(settings.BASE_SHARE_PATH, nb.api_path), str(local_path))
-        # local_path.chmod(0o777)
-        return Response('Updated local copy of shared notebook', status=200)
+        # The client already has this version
+        client_version = request.GET.get('version', request.data.get('version') if hasattr(request.data, 'get') else None)
+        if client_version is not None and str(client_version) == str(nb.version):
+            return _versioned(Response(status=304), nb)
 
-    # If the local file is newer, copy to the repo
-    # Local file newer than the repo file
+        return _versioned(Response('Shared notebook already up to date', status=200), nb)
+
+    # Work out which side changed since this collaborator last synced
+    local_changed = local_hash != collaborator.synced_hash
+    share_changed = nb.version != collaborator.synced_version
+
+    # If both sides changed, or neither did although the content differs, or this collaborator has
+    # not synced since versions were added, fall back to comparing the last modified time of the
+    # file with the db entry
+    if not collaborator.synced_hash or local_changed == share_changed:
+        local_last_updated = datetime.fromtimestamp(local_path.stat().st_mtime, timezone.utc)
+        local_changed = nb.last_updated is None or local_last_updated >= nb.last_updated
+
+    # Local file unchanged, or older than the repo file: overwrite the local file and return
+    if not local_changed:
+        _copy_to_local(nb, share_path, str(local_path), collaborator)
+        return _versioned(Response('Updated local copy of shared notebook', status=200), nb)
+
+    # Local file changed, or newer than the repo file: copy to the repo as a new version
     else:
-        copyfile(str(local_path), os.path.join(settings.BASE_SHARE_PATH, nb.api_path))  # Copy the file
-        nb.last_updated = datetime.utcfromtimestamp(local_last_updated)  # Update the database
-        nb.save()
-        return Response('Keeping local copy of shared notebook', status=200)
+        _update_share_file(nb, str(local_path), local_hash, username)
+        _mark_synced(collaborator, nb, local_hash)
+        return _versioned(Response('Keeping local copy of shared notebook', status=200), nb)
 
 
 @api_view(['GET', 'PUT'])
@@ -557,21 +807,149 @@ def editing_heartbeat(request, file_path):  # Pass in Jupyter.notebook.notebook_
     # Get the collaborator object
     collaborator = get_object_or_404(Collaborator, user=username, file_path=file_path)
 
-    # Update the last_accessed timestamp
-    collaborator.last_accessed = datetime.now()  # Update the database
-    collaborator.save()
+    # Record the heartbeat in the presence registry, only occasionally writing last_accessed to the database
+    if presence.heartbeat(collaborator.share_id, username):
+        Collaborator.objects.filter(id=collaborator.id).update(last_accessed=timezone.now())
 
-    # Get who else has a last_accessed within the last minute
-    currently_editing = []
-    all_collaborators = collaborator.share.shared_with.all()
-    for c in all_collaborators:
-        if c.last_accessed is not None and c.last_accessed.timestamp() > (collaborator.last_accessed.timestamp() - 60) and c.user != username:
-            currently_editing.append(c.user)
+    # Get who else has sent a heartbeat within the last minute
+    currently_editing = presence.editors(collaborator.share_id, exclude=username)
 
     # Return list of current editors
     return Response(currently_editing, status=200)
 
 
+@api_view(['GET'])
+@permission_classes((permissions.AllowAny,))
+def wait_for_editors(request, file_path):
+    """
+    Short poll for changes in the list of other users editing a shared notebook. The client
+    passes the comma-separated list of editors it knows about and gets a response as soon
+    as the list changes, or with the unchanged list after the timeout, then polls again.
+    The wait holds a web worker, so it is capped at PRESENCE_MAX_WAIT seconds.
+    """
+    # Get the current username
+    username = request.user.username
+
+    # Get the collaborator object
+    collaborator = get_object_or_404(Collaborator, user=username, file_path=file_path)
+
+    # Get the known editors and how long to wait
+    known = [e for e in request.GET.get('editors', '').split(',') if e]
+    max_wait = getattr(settings, 'PRESENCE_MAX_WAIT', 5)
+    try:
+        timeout = max(0, min(float(request.GET.get('timeout', max_wait)), max_wait))
+    except ValueError:
+        timeout = max_wait
+
+    # Return the list of current editors once it changes
+    currently_editing = presence.wait_for_change(collaborator.share_id, known, exclude=username, timeout=timeout)
+    return Response(currently_editing, status=200)
+
+
+@api_view(['GET'])
+@permission_classes((permissions.AllowAny,))
+def list_revisions(request, pk):
+    # Look up the notebook and make sure the current user is a collaborator
+    nb = get_object_or_404(Share, id=pk)
+    _get_collaborator(nb, request.user)
+
+    # List the revisions, newest first, without loading their cells
+    revisions = ShareRevision.objects.filter(share=nb).order_by('-number') \
+        .values('number', 'created', 'author', 'content_hash', 'cells')
+    return_list = [{
+        'number': r['number'],
+        'created': str(r['created']),
+        'author': r['author'],
+        'content_hash': r['content_hash'],
+        'cells': len(json.loads(r['cells'])),
+    } for r in revisions]
+
+    return _versioned(Response({'current': nb.version, 'revisions': return_list}), nb)
+
+
+@api_view(['PUT'])
+@permission_classes((permissions.AllowAny,))
+def restore_revision(request, pk, number):
+    # Look up the notebook and make sure the current user is a collaborator
+    nb = get_object_or_404(Share, id=pk)
+    username = request.user.username
+    _get_collaborator(nb, request.user)
+    revision = get_object_or_404(ShareRevision, share=nb, number=number)
+
+    # Nothing to do if the shared copy already has this content, compared by cells and header
+    # since a restored copy isn't necessarily byte for byte the file the revision was saved from
+    share_path = os.path.join(settings.BASE_SHARE_PATH, nb.api_path)
+    if revision.content_hash == nb.content_hash or matches_revision(revision, share_path):
+        return _versioned(Response('Shared notebook already matches revision ' + str(revision.number), status=200), nb)
+
+    # Write the reassembled notebook over the shared copy, then record it as a new version,
+    # so that restoring is itself part of the history and collaborators pick it up on their next sync
+    write_revision(revision, share_path)
+    _new_share_version(nb, _file_hash(share_path), username)
+
+    return _versioned(Response(nb.name + ' restored to revision ' + str(revision.number), status=200), nb)
+
+
+def _members_from_request(request):
+    members = request.data['members'] if 'members' in request.data else []
+    if isinstance(members, str):
+        members = members.split(',')
+    return list(dict.fromkeys(m.strip() for m in members if m.strip()))
+
+
+@api_view(['GET', 'PUT', 'DELETE'])
+@permission_classes((permissions.IsAuthenticated,))
+def roster_detail(request, name):
+    """
+    Get, create or replace the members of, or delete a roster. Notebooks are shared with
+    every member of a roster by sharing with group:<name>. Only the roster's owner may
+    change it, and only its owner and members may see who is in it.
+    """
+    username = request.user.username
+    if not username:
+        return_obj = {"error": "Must be logged in to manage rosters."}
+        return Response(return_obj, status=401)
+
+    if request.method == 'GET':
+        roster = get_object_or_404(Roster, name=name)
+        if not _in_roster(roster, request.user):
+            return_obj = {"error": "Unable to view roster due to user permissions."}
+            return Response(return_obj, status=403)
+
+        members = list(roster.members.order_by('user').values_list('user', flat=True))
+        return Response({'name': roster.name, 'owner': roster.owner, 'members': members})
+
+    # Lazily create the roster, owned by the current user
+    if request.method == 'PUT':
+        roster, _ = Roster.objects.get_or_create(name=name, defaults={'owner': username})
+    else:
+        roster = get_object_or_404(Roster, name=name)
+
+    # Only the roster's owner may change it
+    if roster.owner != username:
+        return_obj = {"error": "Unable to change roster due to user permissions."}
+        return Response(return_obj, status=403)
+
+    # Removing a roster removes every share made with it, along with its members' rows
+    if request.method == 'DELETE':
+        roster.delete()
+        return Response(name + " roster removed.", status=200)
+
+    # Replace the membership with set differences, in one transaction
+    requested = _members_from_request(request)
+    with transaction.atomic():
+        existing = set(roster.members.values_list('user', flat=True))
+        removed = existing - set(requested)
+        if removed:
+            roster.members.filter(user__in=removed).delete()
+
+            # Revoke the access they only had through the roster, rows of users also shared with directly have no roster
+            Collaborator.objects.filter(roster=roster, owner=False).filter(Q(user__in=removed) | Q(email__in=removed)).delete()
+        RosterMember.objects.bulk_create([RosterMember(roster=roster, user=user) for user in requested if user not in existing])
+
+    return Response({'name': roster.name, 'owner': roster.owner, 'members': sorted(requested)})
+
+
 ################
 # From urls.py #
 ################
@@ -583,8 +961,13 @@ urlpatterns = [
     url(r'^services/sharing/sharing/(?P<pk>[0-9]+)/decline/$', decline_sharing),
     url(r'^services/sharing/sharing/(?P<pk>[0-9]+)/remove/$', remove_sharing),
     url(r'^services/sharing/sharing/(?P<pk>[0-9]+)/copy/(?P<local_dir_path>.*)$', copy_share),
+    url(r'^services/sharing/sharing/(?P<pk>[0-9]+)/revisions/$', list_revisions),
+    url(r'^services/sharing/sharing/(?P<pk>[0-9]+)/revisions/(?P<number>[0-9]+)/restore/$', restore_revision),
     url(r'^services/sharing/sharing/begin/', begin_sharing),
+    url(r'^services/sharing/sharing/current/batch/$', current_collaborators_batch),
     url(r'^services/sharing/sharing/current/(?P<api_path>.*)$', current_collaborators),
     url(r'^services/sharing/sharing/heartbeat/(?P<file_path>.*)$', editing_heartbeat),
+    url(r'^services/sharing/sharing/editors/(?P<file_path>.*)$', wait_for_editors),
+    url(r'^services/sharing/rosters/(?P<name>[^/]+)/$', roster_detail),
     url(r'^services/sharing/error/$', error_redirect),
 ]
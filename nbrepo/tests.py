@@ -0,0 +1,61 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from nbrepo.models import Notebook, Tag
+
+
+class WeightCursorPaginationTest(TestCase):
+    """
+    Page through catalog lists with more tied weights than CursorPagination's offset cutoff
+    """
+    count = 1250
+
+    def setUp(self):
+        # Catalog responses are cached by URL, and bulk_create doesn't change the catalog version
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(user=User.objects.create(username='reader'))
+
+    def _walk(self, url):
+        ids = []
+        while url is not None:
+            response = self.client.get(url)
+            ids += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+
+            # Fail rather than loop forever if the same page keeps coming back
+            self.assertLessEqual(len(ids), 2 * self.count)
+        return ids
+
+    def test_notebooks(self):
+        Notebook.objects.bulk_create([
+            Notebook(name='nb' + str(i), description='', author='', quality='', publication=date(2020, 1, 1),
+                     owner='owner', file_path='', api_path='/' + str(i))
+            for i in range(self.count)])
+
+        ids = self._walk('/services/sharing/notebooks/')
+        self.assertEqual(len(ids), self.count)
+        self.assertEqual(ids, sorted(Notebook.objects.values_list('id', flat=True)))
+
+    def test_tags(self):
+        Tag.objects.bulk_create([Tag(label='tag' + str(i)) for i in range(self.count)])
+
+        ids = self._walk('/services/sharing/tags/')
+        self.assertEqual(len(ids), self.count)
+        self.assertEqual(ids, sorted(Tag.objects.values_list('id', flat=True)))
+
+    def test_weight_order(self):
+        Tag.objects.bulk_create([Tag(label='tag' + str(i), weight=i % 3) for i in range(300)])
+
+        ids = self._walk('/services/sharing/tags/?page_size=7')
+        self.assertEqual(ids, list(Tag.objects.order_by('weight', 'id').values_list('id', flat=True)))
+
+    def test_page_size(self):
+        Tag.objects.bulk_create([Tag(label='tag' + str(i)) for i in range(20)])
+
+        response = self.client.get('/services/sharing/tags/?page_size=5')
+        self.assertEqual(len(response.data['results']), 5)
@@ -17,10 +17,12 @@ from django.conf.urls import url, include
 from django.contrib import admin
 from rest_framework import routers
 
-from nbrepo.preview import preview, preview_image
-from nbrepo.views import NotebookViewSet, TagViewSet, copy, download, obtain_auth_token, WebtourViewSet, webtour_seen, CommentViewSet, notebook_usage, launch_counter
+from nbrepo.preview import preview, preview_image, preview_variant
+from nbrepo.publishing import publish_status
+from nbrepo.views import NotebookViewSet, TagViewSet, copy, download, obtain_auth_token, WebtourViewSet, webtour_seen, CommentViewSet, notebook_usage, launch_counter, notebook_search, tag_facets
 
 from .sharing import SharingViewSet, CollaboratorViewSet, begin_sharing, accept_sharing, current_collaborators, error_redirect, urlpatterns as sharingpatterns
+from .outbox import urlpatterns as outboxpatterns
 
 # Routers provide an easy way of automatically determining the URL conf.
 router = routers.DefaultRouter()
@@ -42,11 +44,15 @@ urlpatterns = [
 
     # GenePattern Notebook Repo endpoints
     url(r'^services/sharing/notebooks/stats/$', notebook_usage),
+    url(r'^services/sharing/notebooks/search/$', notebook_search),
+    url(r'^services/sharing/notebooks/jobs/(?P<pk>[0-9]+)/$', publish_status),
+    url(r'^services/sharing/tags/facets/$', tag_facets),
     url(r'^services/sharing/notebooks/(?P<pk>[0-9]+)/launched/$', launch_counter),
     url(r'^services/sharing/notebooks/(?P<pk>[0-9]+)/copy/(?P<api_path>.*)$', copy),
     url(r'^services/sharing/notebooks/(?P<pk>[0-9]+)/download/$', download),
     url(r'^services/sharing/notebooks/(?P<pk>[0-9]+)/preview/$', preview),
     url(r'^services/sharing/notebooks/(?P<pk>[0-9]+)/preview/image/$', preview_image),
+    url(r'^services/sharing/notebooks/(?P<pk>[0-9]+)/preview/(?P<name>preview-(?:thumb|card|full)-[0-9a-f]+\.(?:webp|png))$', preview_variant),
 
     # Webtour endpoints
     url(r'^services/sharing/webtours/(?P<user>.*)/$', webtour_seen),
@@ -55,7 +61,9 @@ urlpatterns = [
 # Add the sharing URLs
 urlpatterns += sharingpatterns
 
+# Add the outbox URLs
+urlpatterns += outboxpatterns
+
 urlpatterns += [
     url(r'^services/sharing/', include(router.urls)),
 ]
-
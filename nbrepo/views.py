@@ -1,10 +1,7 @@
 import ntpath
 import os
 import re
-import smtplib
 import urllib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
 import urllib.parse
 import json
@@ -15,9 +12,10 @@ from distutils.errors import DistutilsFileError
 
 from django.contrib.auth.models import User, Group
 from django.conf import settings
-from django.db.models import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+from django.db.models import ObjectDoesNotExist, Count, Sum
+from django.utils.dateparse import parse_date
 from django.shortcuts import redirect
-from django.views.static import serve
 
 from rest_framework import parsers
 from rest_framework import permissions
@@ -29,9 +27,16 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from nbrepo.models import Notebook, Tag, Webtour, Comment
+from nbrepo.models import Notebook, Tag, Webtour, Comment, NotebookUsage, PublishJob
+from nbrepo.pagination import IdCursorPagination, WeightCursorPagination
 from nbrepo.serializers import UserSerializer, GroupSerializer, NotebookSerializer, AuthTokenSerializer, TagSerializer, WebtourSerializer, CommentSerializer
-from .preview import preview, generate_preview, remove_preview
+from .preview import preview, remove_preview
+from .publishing import repo_file_path, submit_publish_job
+from . import blobstore
+from .downloads import serve_notebook
+from .search import index_notebook, unindex_notebook, search
+from .caching import CatalogCacheMixin, bump_catalog_version, cached_catalog_response
+from .counters import counter_service
 
 from .sharing import CollaboratorViewSet, SharingViewSet, accept_sharing, begin_sharing, error_redirect
 
@@ -72,83 +77,21 @@ class CommentViewSet(viewsets.ModelViewSet):
     """
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
+    pagination_class = IdCursorPagination
     filter_fields = ('notebook', 'user', 'timestamp', 'text')
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
 
-class NotebookViewSet(viewsets.ModelViewSet):
+class NotebookViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows notebooks to be viewed or edited.
     """
-    queryset = Notebook.objects.all()
+    queryset = Notebook.objects.all().prefetch_related('tags')
     serializer_class = NotebookSerializer
+    pagination_class = WeightCursorPagination
     filter_fields = ('name', 'author', 'quality', 'owner', 'file_path', 'api_path')
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
-    @staticmethod
-    def _add_publish_metadata(nb_path, nb_url):
-        try:
-            with open(nb_path, 'r') as nb_read:
-                # Get the metadata
-                nb_json = json.load(nb_read)
-                nb_read.close()
-                nb_metadata = nb_json['metadata']
-
-                # Get the GenePattern metadata
-                if 'genepattern' not in nb_metadata:
-                    nb_metadata['genepattern'] = {}
-                nb_genepattern = nb_metadata['genepattern']
-
-                # Set the repository_url
-                nb_genepattern['repository_url'] = nb_url
-
-                # Write back to the file
-                with open(nb_path, 'w') as nb_write:
-                    json.dump(nb_json, nb_write)
-                    nb_write.close()
-
-        except FileNotFoundError:
-            logger.error("Cannot open " + str(nb_path))
-        except KeyError:
-            logger.error("Cannot get metadata for " + str(nb_path))
-
-    @staticmethod
-    def _user_file_path(username, api_path):
-        base_user_path = os.path.join(settings.BASE_USER_PATH, username)
-        decoded_api_path = urllib.parse.unquote(api_path)
-
-        # Get the file path relative to the Jupyter server's home directory
-        file_path = re.search('/notebooks/(.+?)$', decoded_api_path).group(1)
-
-        # If named servers are enabled, get the server name
-        try:
-            named_server = re.search('/user/.*/(.+?)/notebooks/', decoded_api_path).group(1)
-        except AttributeError:
-            named_server = ''
-
-        # Path to the user's notebook file
-        user_nb_path = os.path.join(base_user_path, named_server, file_path)
-        return user_nb_path
-
-    @staticmethod
-    def _copy_to_file_path(username, model_id, api_path):
-        base_repo_path = settings.BASE_REPO_PATH
-
-        # Get the file name and path
-        api_path_parts = api_path.split('/')
-        file_name = urllib.parse.unquote(api_path_parts[len(api_path_parts) - 1])
-        user_nb_path = NotebookViewSet._user_file_path(username, api_path)
-
-        # Path to the repo's notebook file
-        repo_nb_path = os.path.join(base_repo_path, username, str(model_id), file_name)
-
-        # Lazily create directories and copy the file
-        if os.path.exists(user_nb_path):
-            os.makedirs(os.path.dirname(repo_nb_path), exist_ok=True)
-            shutil.copy(user_nb_path, repo_nb_path)
-
-        return repo_nb_path
-
     @staticmethod
     def _remove_notebook_file(file_path):
         id_dir = os.path.dirname(file_path)
@@ -163,21 +106,29 @@ class NotebookViewSet(viewsets.ModelViewSet):
             logger.debug("ERROR: Trying to delete stuff it shouldn't! " + id_dir)
 
     def _apply_tags(self, notebook, tag_list):
-        # Clear the existing tags
-        notebook.tags.clear()
-
-        # Add the new tag list
-        for tag in tag_list:
-            notebook.tags.add(tag)
+        # Replace the existing tags in a single M2M update
+        with transaction.atomic():
+            notebook.tags.set(tag_list)
 
     @staticmethod
-    def _get_or_create_tags(tag_list):
-        tag_obj_list = []
-        for tag_str in tag_list:
-            tag_obj, new = Tag.objects.get_or_create(label=tag_str)
-            tag_obj_list.append(tag_obj)
-
-        return tag_obj_list
+    def _get_or_create_tags(labels):
+        # Look up all existing tags in one query
+        tags = {tag.label: tag for tag in Tag.objects.filter(label__in=labels)}
+
+        # Create the missing tags in bulk, then read them back to get their ids
+        missing = set(labels) - set(tags)
+        if missing:
+            try:
+                with transaction.atomic():
+                    Tag.objects.bulk_create([Tag(label=label) for label in missing])
+            except IntegrityError:
+                # Another request created some of the same tags first and the whole insert was rolled back,
+                # so create the rest one at a time
+                for label in missing:
+                    Tag.objects.get_or_create(label=label)
+            tags.update({tag.label: tag for tag in Tag.objects.filter(label__in=missing)})
+
+        return list(tags.values())
 
     @staticmethod
     def _no_pinned_tags(tags_list):
@@ -190,57 +141,30 @@ class NotebookViewSet(viewsets.ModelViewSet):
         return no_pinned
 
     def _validate_tags(self, request):
-        # Get the list of raw tags
+        # Get the set of raw tags, lowercase normalized, without empty tags or duplicates
         tags_str = request.data['tags']
-        tags_list = tags_str.split(',')
-
-        # Lowercase normalize the tags
-        tags_list = [x.lower() for x in tags_list]
-
-        # Remove empty tags
-        for tag in tags_list:
-            if not tag.strip():
-                tags_list.remove(tag)
+        labels = {x.lower() for x in tags_str.split(',') if x.strip()}
 
-        # Remove all duplicates in the list
-        tags_list = list(set(tags_list))
-
-        # Convert tag strings to tag objects
-        tags_list = self._get_or_create_tags(tags_list)
+        # Resolve the community tag along with the others, in case it needs to be applied
+        release = request.data['quality'] == 'Release'
+        resolved = self._get_or_create_tags(labels | {'community'} if release else labels)
+        community_tag = next((tag for tag in resolved if tag.label == 'community'), None)
+        tags_list = [tag for tag in resolved if tag.label in labels]
 
         # Filter out protected tags, if not whitelisted
         if request.user.username not in settings.CAN_SET_PROTECTED_TAGS:
-            for tag in tags_list:
-                if tag.protected:
-                    tags_list.remove(tag)
+            tags_list = [tag for tag in tags_list if not tag.protected]
 
         # Apply community tag if release quality and no pinned tags
-        if request.data['quality'] == 'Release' and self._no_pinned_tags(tags_list):
-            community_tag = Tag.objects.get_or_create(label='community')[0]
+        if release and self._no_pinned_tags(tags_list):
             tags_list.append(community_tag)
 
         # Return the list of validated tag objects
         return tags_list
 
-    def _send_email(self, notebook):
-        if hasattr(settings, 'NOTIFICATION_EMAIL') and settings.NOTIFICATION_EMAIL:
-            fromaddr = "gp-info@broadinstitute.org"
-            preview = f"{settings.BASE_HUB_URL}/services/sharing/notebooks/{notebook.id}/preview/"
-            body = f"<p>A new notebook has been published to the notebook repository:</p>" + \
-                   f"<p><a href='{preview}'>{preview}</a></p>"
-
-            msg = MIMEMultipart()
-            msg['From'] = fromaddr
-            msg['To'] = settings.NOTIFICATION_EMAIL
-            msg['Subject'] = f"Notebook Published: {notebook.name}"
-            msg.attach(MIMEText(body, 'html'))
-
-            server = smtplib.SMTP(settings.EMAIL_SERVER, 25)
-            if hasattr(settings, 'EMAIL_USERNAME'):
-                server.login(settings.EMAIL_USERNAME, settings.EMAIL_PASSWORD)
-            text = msg.as_string()
-            server.sendmail(fromaddr, settings.NOTIFICATION_EMAIL.split(', '), text)
-            server.quit()
+    @staticmethod
+    def _job_status(job):
+        return {'id': job.id, 'status': job.status, 'url': '/services/sharing/notebooks/jobs/%s/' % job.id}
 
     def create(self, request, *args, **kwargs):
         logger.debug("CREATE NOTEBOOK")
@@ -253,14 +177,8 @@ class NotebookViewSet(viewsets.ModelViewSet):
         new_id = response.data['id']
         api_path = response.data['api_path']
 
-        # Get the path to the user's copy
-        user_file_path = self._user_file_path(username, api_path)
-
-        # Copy the notebook to the file path
-        response.data['file_path'] = self._copy_to_file_path(username, new_id, api_path)
-
-        # Generate the static preview
-        generate_preview(response.data['file_path'])
+        # Get the path the notebook will be copied to
+        response.data['file_path'] = repo_file_path(username, new_id, api_path)
 
         # Update notebook model with the real file path
         notebook = Notebook.objects.get(id=new_id)
@@ -273,12 +191,16 @@ class NotebookViewSet(viewsets.ModelViewSet):
         # Save the notebook
         notebook.save()
 
-        # Insert the publishing metadata in the notebook file
-        self._add_publish_metadata(user_file_path, response.data['url'])      # Add to user's copy
-        self._add_publish_metadata(notebook.file_path, response.data['url'])  # Add to canonical copy
+        # Add the notebook to the search index
+        index_notebook(notebook)
 
-        # Send notification email
-        self._send_email(notebook)
+        # Invalidate cached catalog responses
+        bump_catalog_version()
+
+        # Copy the file, insert the publishing metadata, generate the preview and send the
+        # notification email in the background, the client can poll the job for progress
+        job = submit_publish_job(notebook, PublishJob.CREATE, response.data['url'])
+        response.data['job'] = self._job_status(job)
 
         # Return response
         return response
@@ -293,17 +215,18 @@ class NotebookViewSet(viewsets.ModelViewSet):
         # Create updated model and response
         response = super(NotebookViewSet, self).update(request, *args, **kwargs)
 
-        # Get the model ID and API path
-        username = response.data['owner']
-        old_id = response.data['id']
-        api_path = response.data['api_path']
+        # Get the updated notebook model
+        notebook = Notebook.objects.get(id=response.data['id'])
+
+        # Update the notebook in the search index
+        index_notebook(notebook)
 
-        # Copy the notebook to the file path
-        self._copy_to_file_path(username, old_id, api_path)
+        # Invalidate cached catalog responses
+        bump_catalog_version()
 
-        # Generate the static preview
-        remove_preview(response.data['file_path'])
-        generate_preview(response.data['file_path'])
+        # Copy the file and regenerate the preview in the background
+        job = submit_publish_job(notebook, PublishJob.UPDATE)
+        response.data['job'] = self._job_status(job)
 
         # Return response
         return response
@@ -314,12 +237,21 @@ class NotebookViewSet(viewsets.ModelViewSet):
         # Get the model file path
         notebook = self.get_object()
         file_path = notebook.file_path
+        notebook_id = notebook.id
+        content_hash = notebook.content_hash
 
         # Delete the model
         response = super(NotebookViewSet, self).destroy(request, *args, **kwargs)
 
-        # Remove the notebook from the file system
+        # Remove the notebook from the search index
+        unindex_notebook(notebook_id)
+
+        # Invalidate cached catalog responses
+        bump_catalog_version()
+
+        # Remove the notebook from the file system and release its blob
         self._remove_notebook_file(file_path)
+        blobstore.release(content_hash)
 
         # Remove the preview from the file system
         remove_preview(file_path)
@@ -350,21 +282,60 @@ def webtour_seen(request, user):
         return Response({'seen': True})
 
 
-class TagViewSet(viewsets.ModelViewSet):
+class TagViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows tags to be viewed or edited.
     """
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    pagination_class = WeightCursorPagination
+
+    def perform_create(self, serializer):
+        serializer.save()
+        bump_catalog_version()
+
+    def perform_update(self, serializer):
+        tag = serializer.save()
+
+        # Reindex the tagged notebooks, in case the label changed
+        for notebook in tag.notebook_set.all().prefetch_related('tags'):
+            index_notebook(notebook)
+
+        bump_catalog_version()
+
+    def perform_destroy(self, instance):
+        notebook_ids = list(instance.notebook_set.values_list('id', flat=True))
+        instance.delete()
+
+        # Reindex the notebooks that had the tag, so that its label no longer matches them
+        for notebook in Notebook.objects.filter(id__in=notebook_ids).prefetch_related('tags'):
+            index_notebook(notebook)
+
+        bump_catalog_version()
+
+
+@api_view(['GET'])
+@permission_classes((permissions.AllowAny,))
+def tag_facets(request):
+    def build_response():
+        # Count the notebooks with each tag in a single aggregate query
+        facets = Tag.objects.annotate(notebooks=Count('notebook')) \
+            .values('id', 'label', 'pinned', 'protected', 'weight', 'notebooks').order_by('weight', 'id')
+        return Response(list(facets))
+
+    # Tag counts only change with the catalog, so serve them from the catalog cache
+    return cached_catalog_response(request, build_response)
 
 
 @api_view(['PUT'])
 @permission_classes((permissions.AllowAny,))
 def launch_counter(request, pk):
-    # Get the notebook and increment the counter
-    notebook = Notebook.objects.get(pk=pk)
-    notebook.launched += 1
-    notebook.save()
+    # Make sure the notebook exists
+    if not Notebook.objects.filter(pk=pk).exists():
+        return Response("Notebook does not exist", status=status.HTTP_400_BAD_REQUEST)
+
+    # Increment the counter, it will be written to the database in the next batch
+    counter_service.increment(pk, 'launched')
 
     # Return an OK response
     return Response("OK")
@@ -373,24 +344,73 @@ def launch_counter(request, pk):
 @api_view(['GET'])
 @permission_classes((permissions.AllowAny,))
 def notebook_usage(request):
-    # Get all notebooks
-    notebooks = Notebook.objects.all()
+    """
+    Report launches and copies per notebook id. Without a date range, report the all-time
+    totals. With since and/or until (YYYY-MM-DD, inclusive), report the totals of the daily
+    usage table in that range, broken down by day if interval=day is given.
+    """
+    # Parse the optional date range
+    try:
+        since = parse_date(request.GET['since']) if 'since' in request.GET else None
+        until = parse_date(request.GET['until']) if 'until' in request.GET else None
+    except ValueError:
+        since = until = None
+    if ('since' in request.GET and since is None) or ('until' in request.GET and until is None):
+        return Response("Dates must be formatted as YYYY-MM-DD", status=status.HTTP_400_BAD_REQUEST)
+    by_day = request.GET.get('interval') == 'day'
 
     # Create the usage object to report
     usage = {}
 
-    # Loop over all notebooks
-    for nb in notebooks:
-        # Create the report object for each notebook
-        report = {'copied': nb.copied, 'launched': nb.launched}
-
-        # Add the report to the usage object
-        usage[nb.name] = report
+    # No range, report the all-time totals, including counts not yet flushed
+    if since is None and until is None and not by_day:
+        pending = counter_service.pending()
+        for nb in Notebook.objects.values('id', 'name', 'copied', 'launched'):
+            delta = pending.get(nb['id'], {})
+            usage[nb['id']] = {'name': nb['name'],
+                               'copied': nb['copied'] + delta.get('copied', 0),
+                               'launched': nb['launched'] + delta.get('launched', 0)}
+        return Response(usage)
+
+    # Otherwise, aggregate the daily usage table in a single query
+    rows = NotebookUsage.objects.all()
+    if since is not None:
+        rows = rows.filter(date__gte=since)
+    if until is not None:
+        rows = rows.filter(date__lte=until)
+    group_by = ('notebook_id', 'notebook__name', 'date') if by_day else ('notebook_id', 'notebook__name')
+    rows = rows.values(*group_by).annotate(copied_sum=Sum('copied'), launched_sum=Sum('launched')).order_by(*group_by)
+
+    for row in rows:
+        report = usage.setdefault(row['notebook_id'], {'name': row['notebook__name'], 'copied': 0, 'launched': 0})
+        report['copied'] += row['copied_sum']
+        report['launched'] += row['launched_sum']
+        if by_day:
+            report.setdefault('days', {})[row['date'].isoformat()] = {'copied': row['copied_sum'],
+                                                                      'launched': row['launched_sum']}
 
     # Return the report in a JSON structure
     return Response(usage)
 
 
+@api_view(['GET'])
+@permission_classes((permissions.AllowAny,))
+def notebook_search(request):
+    # Get the search query and the maximum number of results
+    query = request.GET.get('q', '')
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 50)), 200))
+    except ValueError:
+        return Response("Limit must be an integer", status=status.HTTP_400_BAD_REQUEST)
+
+    # Search the catalog and serialize the ranked results
+    notebooks = search(query, limit)
+    serializer = NotebookSerializer(notebooks, many=True, context={'request': request})
+
+    # Return the results in rank order
+    return Response({'query': query, 'results': serializer.data})
+
+
 @api_view(['GET', 'POST'])
 @permission_classes((permissions.IsAuthenticatedOrReadOnly,))
 def copy(request, pk, api_path):
@@ -402,8 +422,7 @@ def copy(request, pk, api_path):
         notebook = Notebook.objects.get(pk=pk)
 
         # Increment the copied counter
-        notebook.copied += 1
-        notebook.save()
+        counter_service.increment(notebook.id, 'copied')
 
         # Get the user's username
         username = request.user.username
@@ -447,8 +466,8 @@ def copy(request, pk, api_path):
                 file_name_used = 'copy' + str(count) + '_' + file_name
                 copy_to_file = os.path.join(copy_to_dir, file_name_used)
 
-        # Copy the notebook to the current directory
-        shutil.copyfile(notebook.file_path, copy_to_file)
+        # Copy the notebook to the current directory, cloning the stored blob where possible
+        blobstore.materialize(notebook.file_path, copy_to_file, notebook.content_hash)
         os.chmod(copy_to_file, 0o777)
 
         # Get the URL to the new copy of the notebook file
@@ -477,10 +496,8 @@ def download(request, pk):
     # Get the notebook model
     notebook = Notebook.objects.get(pk=pk)
 
-    # Serve the file
-    response = serve(request, os.path.basename(notebook.file_path), os.path.dirname(notebook.file_path))
-    response['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(notebook.file_path)
-    return response
+    # Serve the file, precompressed if the client accepts it
+    return serve_notebook(request, notebook.file_path, os.path.basename(notebook.file_path))
 
 
 @api_view(['POST'])
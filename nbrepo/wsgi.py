@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nbrepo.settings")
 
 application = get_wsgi_application()
+
+# Deliver any email left in the outbox by a previous run. The server loads this module in each
+# worker, while management commands never do, so they don't start a sender of their own.
+from nbrepo.outbox import start_sender
+
+start_sender()